@@ -16,6 +16,7 @@ import pytest
 
 from requests.packages import urllib3
 from testutils.common import wait_for_traefik
+from testutils.infra.container_manager.kubernetes_manager import close_port_forwards
 
 urllib3.disable_warnings()
 
@@ -23,3 +24,7 @@ urllib3.disable_warnings()
 pytest.register_assert_rewrite("testutils")
 
 wait_for_traefik("mender-api-gateway")
+
+
+def pytest_sessionfinish(session, exitstatus):
+    close_port_forwards()
@@ -26,6 +26,7 @@ from testutils.common import (
     clean_mongo,
     create_org,
     create_random_authset,
+    DeviceDirectory,
     change_authset_status,
 )
 
@@ -56,9 +57,12 @@ def tenants_users_devices(tenants, mongo):
         r = uc.call("POST", useradm.URL_LOGIN, auth=(user.name, user.pwd))
         assert r.status_code == 200
         utoken = r.text
+        directory = DeviceDirectory(devauthm, utoken)
 
         for _ in range(2):
-            aset = create_random_authset(devauthd, devauthm, utoken, t.tenant_token)
+            aset = create_random_authset(
+                devauthd, devauthm, utoken, t.tenant_token, directory
+            )
             dev = Device(aset.did, aset.id_data, aset.pubkey, t.tenant_token)
             dev.authsets.append(aset)
             t.devices.append(dev)
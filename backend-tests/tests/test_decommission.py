@@ -29,6 +29,7 @@ from testutils.common import (
     clean_mongo,
     create_org,
     create_random_authset,
+    DeviceDirectory,
     change_authset_status,
     create_user,
 )
@@ -78,9 +79,10 @@ def devices(clean_migrated_mongo, user):
     utoken = r.text
 
     devices = []
+    directory = DeviceDirectory(devauthm, utoken)
 
     for _ in range(2):
-        aset = create_random_authset(devauthd, devauthm, utoken)
+        aset = create_random_authset(devauthd, devauthm, utoken, directory=directory)
         dev = Device(aset.did, aset.id_data, aset.pubkey)
         dev.authsets.append(aset)
         devices.append(dev)
@@ -114,9 +116,12 @@ def tenants_users_devices(tenants, clean_migrated_mongo_mt):
         r = useradmm.call("POST", useradm.URL_LOGIN, auth=(user.name, user.pwd))
         assert r.status_code == 200
         utoken = r.text
+        directory = DeviceDirectory(devauthm, utoken)
 
         for _ in range(2):
-            aset = create_random_authset(devauthd, devauthm, utoken, t.tenant_token)
+            aset = create_random_authset(
+                devauthd, devauthm, utoken, t.tenant_token, directory
+            )
             dev = Device(aset.did, aset.id_data, aset.pubkey, t.tenant_token)
             dev.authsets.append(aset)
             t.devices.append(dev)
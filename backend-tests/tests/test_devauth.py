@@ -40,6 +40,7 @@ from testutils.common import (
     create_authset,
     get_device_by_id_data,
     change_authset_status,
+    DeviceDirectory,
     wait_for_traefik,
 )
 
@@ -82,9 +83,10 @@ def devices(clean_migrated_mongo, user):
     utoken = r.text
 
     devices = []
+    directory = DeviceDirectory(devauthm, utoken)
 
     for _ in range(5):
-        aset = create_random_authset(devauthd, devauthm, utoken)
+        aset = create_random_authset(devauthd, devauthm, utoken, directory=directory)
         dev = Device(aset.did, aset.id_data, aset.pubkey)
         devices.append(dev)
 
@@ -117,9 +119,12 @@ def tenants_users_devices(clean_migrated_mongo_mt, tenants_users):
         r = uc.call("POST", useradm.URL_LOGIN, auth=(user.name, user.pwd))
         assert r.status_code == 200
         utoken = r.text
+        directory = DeviceDirectory(devauthm, utoken)
 
         for _ in range(5):
-            aset = create_random_authset(devauthd, devauthm, utoken, t.tenant_token)
+            aset = create_random_authset(
+                devauthd, devauthm, utoken, t.tenant_token, directory
+            )
             dev = Device(aset.did, aset.id_data, aset.pubkey, t.tenant_token)
             t.devices.append(dev)
 
@@ -337,6 +342,7 @@ def make_devs_with_authsets(user, tenant_token=""):
     utoken = r.text
 
     devices = []
+    directory = DeviceDirectory(ApiClient(deviceauth.URL_MGMT), utoken)
 
     def keygen_rsa():
         return crypto.get_keypair_rsa()
@@ -349,100 +355,126 @@ def make_devs_with_authsets(user, tenant_token=""):
 
     # some vanilla 'pending' devices, single authset
     for _ in range(3):
-        dev = make_pending_device(utoken, keygen_rsa, 1, tenant_token=tenant_token)
+        dev = make_pending_device(
+            utoken, keygen_rsa, 1, tenant_token=tenant_token, directory=directory
+        )
         devices.append(dev)
 
     for _ in range(2):
-        dev = make_pending_device(utoken, keygen_ec_256, 1, tenant_token=tenant_token)
+        dev = make_pending_device(
+            utoken, keygen_ec_256, 1, tenant_token=tenant_token, directory=directory
+        )
         devices.append(dev)
 
-    dev = make_pending_device(utoken, keygen_ed, 1, tenant_token=tenant_token)
+    dev = make_pending_device(
+        utoken, keygen_ed, 1, tenant_token=tenant_token, directory=directory
+    )
     devices.append(dev)
 
     # some pending devices with > 1 authsets
     for i in range(2):
-        dev = make_pending_device(utoken, keygen_rsa, 3, tenant_token=tenant_token)
+        dev = make_pending_device(
+            utoken, keygen_rsa, 3, tenant_token=tenant_token, directory=directory
+        )
         devices.append(dev)
 
     for i in range(2):
-        dev = make_pending_device(utoken, keygen_ec_256, 3, tenant_token=tenant_token)
+        dev = make_pending_device(
+            utoken, keygen_ec_256, 3, tenant_token=tenant_token, directory=directory
+        )
         devices.append(dev)
 
-    dev = make_pending_device(utoken, keygen_ed, 3, tenant_token=tenant_token)
+    dev = make_pending_device(
+        utoken, keygen_ed, 3, tenant_token=tenant_token, directory=directory
+    )
     devices.append(dev)
 
     # some 'accepted' devices, single authset
     for _ in range(3):
         dev = make_accepted_device_with_multiple_authsets(
-            utoken, keygen_rsa, 1, tenant_token=tenant_token
+            utoken, keygen_rsa, 1, tenant_token=tenant_token, directory=directory
         )
         devices.append(dev)
 
     for _ in range(2):
         dev = make_accepted_device_with_multiple_authsets(
-            utoken, keygen_ec_256, 1, tenant_token=tenant_token
+            utoken, keygen_ec_256, 1, tenant_token=tenant_token, directory=directory
         )
         devices.append(dev)
 
     dev = make_accepted_device_with_multiple_authsets(
-        utoken, keygen_ed, 1, tenant_token=tenant_token
+        utoken, keygen_ed, 1, tenant_token=tenant_token, directory=directory
     )
     devices.append(dev)
 
     # some 'accepted' devices with >1 authsets
     for _ in range(2):
         dev = make_accepted_device_with_multiple_authsets(
-            utoken, keygen_rsa, 3, tenant_token=tenant_token
+            utoken, keygen_rsa, 3, tenant_token=tenant_token, directory=directory
         )
         devices.append(dev)
 
     for _ in range(2):
         dev = make_accepted_device_with_multiple_authsets(
-            utoken, keygen_ec_256, 2, tenant_token=tenant_token
+            utoken, keygen_ec_256, 2, tenant_token=tenant_token, directory=directory
         )
         devices.append(dev)
 
     dev = make_accepted_device_with_multiple_authsets(
-        utoken, keygen_ed, 2, tenant_token=tenant_token
+        utoken, keygen_ed, 2, tenant_token=tenant_token, directory=directory
     )
     devices.append(dev)
 
     # some rejected devices
     for _ in range(2):
-        dev = make_rejected_device(utoken, keygen_rsa, 3, tenant_token=tenant_token)
+        dev = make_rejected_device(
+            utoken, keygen_rsa, 3, tenant_token=tenant_token, directory=directory
+        )
         devices.append(dev)
 
     for _ in range(2):
-        dev = make_rejected_device(utoken, keygen_ec_256, 2, tenant_token=tenant_token)
+        dev = make_rejected_device(
+            utoken, keygen_ec_256, 2, tenant_token=tenant_token, directory=directory
+        )
         devices.append(dev)
 
-    dev = make_rejected_device(utoken, keygen_ed, 2, tenant_token=tenant_token)
+    dev = make_rejected_device(
+        utoken, keygen_ed, 2, tenant_token=tenant_token, directory=directory
+    )
     devices.append(dev)
 
     # preauth'd devices
-    dev = make_preauthd_device(utoken, keygen_rsa)
+    dev = make_preauthd_device(utoken, keygen_rsa, directory)
     devices.append(dev)
 
-    dev = make_preauthd_device(utoken, keygen_ec_256)
+    dev = make_preauthd_device(utoken, keygen_ec_256, directory)
     devices.append(dev)
 
-    dev = make_preauthd_device(utoken, keygen_ed)
+    dev = make_preauthd_device(utoken, keygen_ed, directory)
     devices.append(dev)
 
     # preauth'd devices with extra 'pending' sets
     for i in range(2):
         dev = make_preauthd_device_with_pending(
-            utoken, keygen_rsa, num_pending=2, tenant_token=tenant_token
+            utoken,
+            keygen_rsa,
+            num_pending=2,
+            tenant_token=tenant_token,
+            directory=directory,
         )
         devices.append(dev)
 
     dev = make_preauthd_device_with_pending(
-        utoken, keygen_ec_256, num_pending=2, tenant_token=tenant_token
+        utoken,
+        keygen_ec_256,
+        num_pending=2,
+        tenant_token=tenant_token,
+        directory=directory,
     )
     devices.append(dev)
 
     dev = make_preauthd_device_with_pending(
-        utoken, keygen_ed, num_pending=2, tenant_token=tenant_token
+        utoken, keygen_ed, num_pending=2, tenant_token=tenant_token, directory=directory
     )
     devices.append(dev)
 
@@ -471,7 +503,9 @@ def rand_id_data():
     return {"mac": mac, "sn": sn}
 
 
-def make_pending_device(utoken, keygen, num_auth_sets=1, tenant_token=""):
+def make_pending_device(
+    utoken, keygen, num_auth_sets=1, tenant_token="", directory=None
+):
     devauthm = ApiClient(deviceauth.URL_MGMT)
     devauthd = ApiClient(deviceauth.URL_DEVICES)
 
@@ -481,7 +515,14 @@ def make_pending_device(utoken, keygen, num_auth_sets=1, tenant_token=""):
     for i in range(num_auth_sets):
         priv, pub = keygen()
         new_set = create_authset(
-            devauthd, devauthm, id_data, pub, priv, utoken, tenant_token=tenant_token
+            devauthd,
+            devauthm,
+            id_data,
+            pub,
+            priv,
+            utoken,
+            tenant_token=tenant_token,
+            directory=directory,
         )
 
         if dev is None:
@@ -495,11 +536,13 @@ def make_pending_device(utoken, keygen, num_auth_sets=1, tenant_token=""):
 
 
 def make_accepted_device_with_multiple_authsets(
-    utoken, keygen, num_auth_sets=1, num_accepted=1, tenant_token=""
+    utoken, keygen, num_auth_sets=1, num_accepted=1, tenant_token="", directory=None
 ):
     devauthm = ApiClient(deviceauth.URL_MGMT)
 
-    dev = make_pending_device(utoken, keygen, num_auth_sets, tenant_token=tenant_token)
+    dev = make_pending_device(
+        utoken, keygen, num_auth_sets, tenant_token=tenant_token, directory=directory
+    )
 
     for i in range(num_accepted):
         aset_id = dev.authsets[i].id
@@ -512,10 +555,14 @@ def make_accepted_device_with_multiple_authsets(
     return dev
 
 
-def make_rejected_device(utoken, keygen, num_auth_sets=1, tenant_token=""):
+def make_rejected_device(
+    utoken, keygen, num_auth_sets=1, tenant_token="", directory=None
+):
     devauthm = ApiClient(deviceauth.URL_MGMT)
 
-    dev = make_pending_device(utoken, keygen, num_auth_sets, tenant_token=tenant_token)
+    dev = make_pending_device(
+        utoken, keygen, num_auth_sets, tenant_token=tenant_token, directory=directory
+    )
 
     for i in range(num_auth_sets):
         aset_id = dev.authsets[i].id
@@ -528,7 +575,7 @@ def make_rejected_device(utoken, keygen, num_auth_sets=1, tenant_token=""):
     return dev
 
 
-def make_preauthd_device(utoken, keygen):
+def make_preauthd_device(utoken, keygen, directory=None):
     devauthm = ApiClient(deviceauth.URL_MGMT)
 
     priv, pub = keygen()
@@ -538,7 +585,7 @@ def make_preauthd_device(utoken, keygen):
     r = devauthm.with_auth(utoken).call("POST", deviceauth.URL_MGMT_DEVICES, body)
     assert r.status_code == 201
 
-    api_dev = get_device_by_id_data(devauthm, id_data, utoken)
+    api_dev = get_device_by_id_data(devauthm, id_data, utoken, directory)
     assert len(api_dev["auth_sets"]) == 1
     aset = api_dev["auth_sets"][0]
 
@@ -552,11 +599,15 @@ def make_preauthd_device(utoken, keygen):
     return dev
 
 
-def make_preauthd_device_with_pending(utoken, keygen, num_pending=1, tenant_token=""):
+def make_preauthd_device_with_pending(
+    utoken, keygen, num_pending=1, tenant_token="", directory=None
+):
     devauthm = ApiClient(deviceauth.URL_MGMT)
     devauthd = ApiClient(deviceauth.URL_DEVICES)
+    if directory is None:
+        directory = DeviceDirectory(devauthm, utoken)
 
-    dev = make_preauthd_device(utoken, keygen)
+    dev = make_preauthd_device(utoken, keygen, directory)
 
     for i in range(num_pending):
         priv, pub = crypto.get_keypair_rsa()
@@ -568,6 +619,7 @@ def make_preauthd_device_with_pending(utoken, keygen, num_pending=1, tenant_toke
             priv,
             utoken,
             tenant_token=tenant_token,
+            directory=directory,
         )
         dev.authsets.append(
             Authset(aset.id, aset.did, dev.id_data, pub, priv, "pending")
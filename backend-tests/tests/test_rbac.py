@@ -25,6 +25,7 @@ from testutils.common import (
     create_org,
     create_user,
     make_accepted_device,
+    DeviceDirectory,
     mongo,
     clean_mongo,
 )
@@ -95,13 +96,14 @@ def setup_tenant_devices(tenant, device_groups):
     group = None
 
     login_tenant_users(tenant)
+    directory = DeviceDirectory(devauth_MGMT, user.token)
 
     tenant.devices = []
     for group, dev_cnt in device_groups.items():
         grouped_devices[group] = []
         for i in range(dev_cnt):
             device = make_accepted_device(
-                devauth_DEV, devauth_MGMT, user.token, tenant.tenant_token
+                devauth_DEV, devauth_MGMT, user.token, tenant.tenant_token, directory
             )
             if group is not None:
                 rsp = invtry_MGMT.with_auth(user.token).call(
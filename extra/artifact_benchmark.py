@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# Copyright 2020 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Benchmarks of the in-process artifact builder (testutils.util.artifact).
+
+compression: builds an artifact of the given payload with every available
+codec and reports build time, artifact size and payload decompression time
+(zstd needs the zstandard package, it is skipped without it), e.g.
+
+    extra/artifact_benchmark.py compression core-image-full-cmdline-qemux86-64.ext4
+
+sparse: builds an artifact of the given (sparse) payload with and without
+sparse-aware reading and reports the build times, the bytes produced from
+holes and whether both artifacts are identical.
+
+delta: builds a full rootfs-image artifact of the target image and a binary
+delta artifact from the source to the target image (needs xdelta3), and
+reports their build times and sizes, e.g.
+
+    extra/artifact_benchmark.py delta release-1.ext4 release-2.ext4
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import tarfile
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from testutils.util.artifact import (
+    Artifact,
+    COMPRESSIONS,
+    delta_rootfs_image,
+    rootfs_image,
+)
+
+
+def parse_levels(levels):
+    """Parses "gzip=6,zstd=19" into {"gzip": 6, "zstd": 19}."""
+    result = {}
+    for item in filter(None, levels.split(",")):
+        codec, level = item.split("=", 1)
+        result[codec] = int(level)
+    return result
+
+
+def decompress_payload(artifact_path, compression):
+    """Reads the first payload of an artifact through its decompressor,
+    returns the number of uncompressed bytes."""
+    size = 0
+    with tarfile.open(artifact_path, mode="r") as tar:
+        for member in tar:
+            if not member.name.startswith("data/"):
+                continue
+            compressed = tar.extractfile(member)
+            reader = COMPRESSIONS[compression].reader(compressed)
+            while True:
+                buf = reader.read(1024 * 1024)
+                if not buf:
+                    break
+                size += len(buf)
+            break
+    return size
+
+
+def bench_compression(args):
+    levels = parse_levels(args.levels)
+    codecs = args.codecs.split(",")
+    payload_size = os.path.getsize(args.payload)
+
+    print(
+        "%-6s %5s %10s %14s %7s %12s"
+        % ("codec", "level", "build [s]", "size [B]", "ratio", "decomp [s]")
+    )
+    for codec in codecs:
+        if not COMPRESSIONS[codec].available:
+            print("%-6s skipped, not available here" % codec)
+            continue
+        level = levels.get(codec, COMPRESSIONS[codec].default_level)
+        with open(args.payload, "rb") as payload, tempfile.TemporaryDirectory(
+            dir=args.tmpdir
+        ) as tmpdir:
+            artifact = Artifact(
+                "benchmark",
+                ["benchmark"],
+                payload=payload,
+                compression=codec,
+                compression_level=level,
+                compression_workers=args.workers,
+            )
+            path = os.path.join(tmpdir, "benchmark.mender")
+
+            start = time.perf_counter()
+            artifact.write(path)
+            build_time = time.perf_counter() - start
+            size = os.path.getsize(path)
+
+            start = time.perf_counter()
+            decompress_payload(path, codec)
+            decompress_time = time.perf_counter() - start
+
+        print(
+            "%-6s %5s %10.2f %14d %7.3f %12.2f"
+            % (
+                codec,
+                level if level is not None else "-",
+                build_time,
+                size,
+                size / payload_size if payload_size else 0,
+                decompress_time,
+            )
+        )
+
+
+def bench_sparse(args):
+    size = os.path.getsize(args.payload)
+    allocated = os.stat(args.payload).st_blocks * 512
+    print(
+        "payload: %d bytes, %d allocated (%.1f%%)"
+        % (size, allocated, 100.0 * allocated / size if size else 0)
+    )
+    print("%-7s %10s %14s" % ("sparse", "build [s]", "holes [B]"))
+    digests = set()
+    for sparse in (False, True):
+        with open(args.payload, "rb") as payload, tempfile.TemporaryDirectory(
+            dir=args.tmpdir
+        ) as tmpdir:
+            artifact = Artifact(
+                "benchmark",
+                ["benchmark"],
+                payload=payload,
+                compression=args.compression,
+                compression_workers=args.workers,
+                sparse=sparse,
+            )
+            path = os.path.join(tmpdir, "benchmark.mender")
+
+            start = time.perf_counter()
+            artifact.write(path)
+            build_time = time.perf_counter() - start
+
+            sha = hashlib.sha256()
+            with open(path, "rb") as f:
+                for buf in iter(lambda: f.read(1024 * 1024), b""):
+                    sha.update(buf)
+            digests.add(sha.hexdigest())
+        print("%-7s %10.2f %14d" % (sparse, build_time, artifact.hole_bytes))
+    print("identical artifacts: %s" % (len(digests) == 1))
+
+
+def bench_delta(args):
+    builds = (
+        (
+            "full (%s)" % args.compression,
+            lambda: rootfs_image(
+                "benchmark",
+                ["benchmark"],
+                open(args.target, "rb"),
+                compression=args.compression,
+                compression_workers=args.workers,
+            ),
+        ),
+        (
+            "delta",
+            lambda: delta_rootfs_image(
+                "benchmark",
+                ["benchmark"],
+                args.source,
+                args.target,
+                delta_level=args.level,
+            ),
+        ),
+    )
+    print("%-12s %10s %14s %7s" % ("artifact", "build [s]", "size [B]", "ratio"))
+    full_size = None
+    for name, build in builds:
+        with tempfile.TemporaryDirectory(dir=args.tmpdir) as tmpdir:
+            path = os.path.join(tmpdir, "benchmark.mender")
+            start = time.perf_counter()
+            build().write(path)
+            build_time = time.perf_counter() - start
+            size = os.path.getsize(path)
+        full_size = full_size or size
+        print("%-12s %10.2f %14d %7.3f" % (name, build_time, size, size / full_size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--tmpdir", default=None, help="where to write the artifacts built"
+    )
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    compression = subparsers.add_parser(
+        "compression", help="compare payload compression codecs"
+    )
+    compression.add_argument("payload", help="payload file, e.g. an ext4 image")
+    compression.add_argument(
+        "--codecs",
+        default=",".join(c for c in COMPRESSIONS if COMPRESSIONS[c].available),
+        help="comma separated codecs to run (default: all available)",
+    )
+    compression.add_argument(
+        "--levels", default="", help='per codec levels, e.g. "gzip=6,zstd=19"'
+    )
+    compression.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="compression threads (default: number of CPUs)",
+    )
+    compression.set_defaults(func=bench_compression)
+
+    sparse = subparsers.add_parser(
+        "sparse", help="compare sparse-aware and plain payload reading"
+    )
+    sparse.add_argument("payload", help="payload file, e.g. an ext4 image")
+    sparse.add_argument(
+        "--compression",
+        default="gzip",
+        choices=COMPRESSIONS.keys(),
+        help="payload compression (default: gzip)",
+    )
+    sparse.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="compression threads (default: number of CPUs)",
+    )
+    sparse.set_defaults(func=bench_sparse)
+
+    delta = subparsers.add_parser(
+        "delta", help="compare delta and full rootfs-image artifacts"
+    )
+    delta.add_argument("source", help="filesystem image installed on the device")
+    delta.add_argument("target", help="filesystem image to update to")
+    delta.add_argument(
+        "--compression",
+        default="gzip",
+        choices=COMPRESSIONS.keys(),
+        help="compression of the full artifact (default: gzip)",
+    )
+    delta.add_argument(
+        "--level", type=int, default=9, help="xdelta3 level (default: 9)"
+    )
+    delta.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="compression threads of the full artifact (default: number of CPUs)",
+    )
+    delta.set_defaults(func=bench_delta)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,16 +12,40 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import atexit
 import os
+import shlex
 import shutil
 import subprocess
+import tempfile
+
+from testutils.util.artifact import rootfs_image, restamp, COMPRESSIONS
+from testutils.util.artifact_cache import get_artifact_cache
 
 from . import logger
 
+# mender-artifact --compression values and the equivalent Artifact
+# compression and level.
+_COMPRESSIONS = {
+    "none": ("none", None),
+    "gzip": ("gzip", None),
+    "lzma": ("xz", None),
+    "zstd_fastest": ("zstd", 1),
+    "zstd_default": ("zstd", 3),
+    "zstd_better": ("zstd", 7),
+    "zstd_best": ("zstd", 11),
+}
+
 
 class Artifacts:
     artifacts_tool_path = "mender-artifact"
 
+    def __init__(self):
+        # Artifacts built in-process, by build inputs: rebuilding one under
+        # another name only rewrites its header, see restamp.
+        self._templates = {}
+        self._templates_dir = None
+
     def reset(self):
         # Reset all temporary values.
         pass
@@ -39,14 +63,123 @@ class Artifacts:
         depends={},
         provides={},
     ):
-        signed_arg = ""
-
         if artifact_name.startswith("artifact_name="):
             artifact_name = artifact_name.split("=")[1]
 
+        private_key = None
         if signed:
             private_key = "../extra/signed-artifact-client-testing/private.key"
             assert os.path.exists(private_key), "private key for testing doesn't exist"
+
+        # Build the artifact in-process, unless it needs mender-artifact
+        # features the Python builder doesn't have (format versions other
+        # than 3, global flags other than --compression, zstd without the
+        # zstandard package).
+        flags = shlex.split(global_flags)
+        compression = ("gzip", None)
+        if len(flags) == 2 and flags[0] == "--compression":
+            compression = _COMPRESSIONS.get(flags[1])
+        elif flags:
+            compression = None
+        if (
+            compression is None
+            or not COMPRESSIONS[compression[0]].available
+            or version not in (None, 3)
+        ):
+            return self._run_mender_artifact(
+                image,
+                device_type,
+                artifact_name,
+                artifact_file_created,
+                private_key,
+                scripts,
+                global_flags,
+                version,
+                depends,
+                provides,
+            )
+
+        state_scripts = {}
+        for script in scripts:
+            # like mender-artifact's -s, a directory stands for its files
+            if os.path.isdir(script):
+                paths = [
+                    os.path.join(script, name) for name in sorted(os.listdir(script))
+                ]
+            else:
+                paths = [script]
+            for path in paths:
+                with open(path, "rb") as f:
+                    state_scripts[os.path.basename(path)] = f.read()
+        key_pem = None
+        if private_key is not None:
+            with open(private_key, "rb") as f:
+                key_pem = f.read()
+
+        st = os.stat(image)
+        template_key = (
+            os.path.abspath(image),
+            st.st_ino,
+            st.st_size,
+            st.st_mtime_ns,
+            device_type,
+            tuple(sorted(state_scripts.items())),
+            compression,
+            tuple(sorted(depends.items())),
+            tuple(sorted(provides.items())),
+        )
+        template = self._templates.get(template_key)
+        if template is not None:
+            logger.info(
+                "Re-stamping rootfs-image artifact of %s as %s" % (image, artifact_name)
+            )
+            restamp(
+                template, artifact_file_created.name, artifact_name, private_key=key_pem
+            )
+            return artifact_file_created.name
+
+        logger.info(
+            "Building rootfs-image artifact %s of %s in-process"
+            % (artifact_name, image)
+        )
+        if self._templates_dir is None:
+            self._templates_dir = tempfile.mkdtemp(prefix="mender-artifacts-")
+            atexit.register(shutil.rmtree, self._templates_dir, True)
+        template = os.path.join(self._templates_dir, "%d.mender" % len(self._templates))
+        with open(image, "rb") as payload:
+            artifact = rootfs_image(
+                artifact_name,
+                [device_type],
+                payload,
+                depends=dict(depends) or None,
+                provides=dict(provides),
+                scripts=state_scripts,
+                compression=compression[0],
+                compression_level=compression[1],
+                private_key=key_pem,
+                cache=get_artifact_cache(),
+            )
+            artifact.write(template)
+        self._templates[template_key] = template
+        shutil.copyfile(template, artifact_file_created.name)
+
+        return artifact_file_created.name
+
+    def _run_mender_artifact(
+        self,
+        image,
+        device_type,
+        artifact_name,
+        artifact_file_created,
+        private_key,
+        scripts,
+        global_flags,
+        version,
+        depends,
+        provides,
+    ):
+        signed_arg = ""
+        if private_key is not None:
             signed_arg = "-k %s" % (private_key)
 
         cmd = "%s %s  write rootfs-image -f %s -t %s -n %s -o %s %s %s" % (
@@ -14,7 +14,6 @@
 
 import json
 import os
-import time
 from requests.auth import HTTPBasicAuth
 
 from . import logger
@@ -23,6 +22,7 @@ from . import get_container_manager
 from .requests_helpers import requests_retry
 
 from testutils.infra.cli import CliUseradm, CliTenantadm
+from testutils.util.wait import wait_until, WaitTimeout
 
 
 class Authentication:
@@ -105,11 +105,15 @@ class Authentication:
 
             # It might take some time for create_org to propagate the new user.
             # Retry login for a minute.
-            for _ in range(60):
-                r = self._do_login(self.username, self.password)
-                if r.status_code == 200:
-                    break
-                time.sleep(1)
+            try:
+                r = wait_until(
+                    lambda: self._do_login(self.username, self.password),
+                    timeout=60,
+                    ready=lambda r: r.status_code == 200,
+                    name="get_auth_token login",
+                )
+            except WaitTimeout as e:
+                r = e.last
             assert r.status_code == 200
 
         return self.auth_header
@@ -20,16 +20,36 @@ from .helpers import Helpers
 
 from testutils.infra.device import MenderDevice, MenderDeviceGroup
 from testutils.infra.container_manager import factory
+from testutils.infra.container_manager.pool import get_environment_pool
 
 container_factory = factory.get_factory()
 
 
+def lease_env(request, key, create, pooled=True):
+    """Returns a running environment of setup type key for the requesting
+    test: with pooled, one leased from the environment pool (returned when
+    the test is done, torn down if it failed), else create() set up."""
+    if not pooled:
+        env = create()
+        request.addfinalizer(env.teardown)
+        env.setup()
+        return env
+
+    pool = get_environment_pool()
+    env = pool.lease(key, create)
+    request.addfinalizer(
+        lambda: pool.release(key, env, failed=conftest.node_failed(request.node))
+    )
+    return env
+
+
 @pytest.fixture(scope="function")
 def standard_setup_one_client(request):
-    env = container_factory.getStandardSetup(num_clients=1)
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = lease_env(
+        request,
+        "standard-1-client",
+        lambda: container_factory.getStandardSetup(num_clients=1),
+    )
 
     env.device = MenderDevice(env.get_mender_clients()[0])
     env.device.ssh_is_opened()
@@ -39,11 +59,13 @@ def standard_setup_one_client(request):
     return env
 
 
-def standard_setup_one_client_bootstrapped_impl(request):
-    env = container_factory.getStandardSetup(num_clients=1)
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+def standard_setup_one_client_bootstrapped_impl(request, pooled=True):
+    env = lease_env(
+        request,
+        "standard-1-client",
+        lambda: container_factory.getStandardSetup(num_clients=1),
+        pooled,
+    )
 
     env.device = MenderDevice(env.get_mender_clients()[0])
     env.device.ssh_is_opened()
@@ -61,15 +83,14 @@ def standard_setup_one_client_bootstrapped(request):
 
 @pytest.fixture(scope="class")
 def class_persistent_standard_setup_one_client_bootstrapped(request):
-    return standard_setup_one_client_bootstrapped_impl(request)
+    return standard_setup_one_client_bootstrapped_impl(request, pooled=False)
 
 
 @pytest.fixture(scope="function")
 def standard_setup_one_rofs_client_bootstrapped(request):
-    env = container_factory.getRofsClientSetup()
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = lease_env(
+        request, "rofs-client", lambda: container_factory.getRofsClientSetup()
+    )
 
     env.device = MenderDevice(env.get_mender_clients()[0])
     env.device.ssh_is_opened()
@@ -82,10 +103,9 @@ def standard_setup_one_rofs_client_bootstrapped(request):
 
 @pytest.fixture(scope="function")
 def standard_setup_one_docker_client_bootstrapped(request):
-    env = container_factory.getDockerClientSetup()
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = lease_env(
+        request, "docker-client", lambda: container_factory.getDockerClientSetup()
+    )
 
     env.device = MenderDevice(env.get_mender_clients()[0])
     env.device.ssh_is_opened()
@@ -98,10 +118,11 @@ def standard_setup_one_docker_client_bootstrapped(request):
 
 @pytest.fixture(scope="function")
 def standard_setup_two_clients_bootstrapped(request):
-    env = container_factory.getStandardSetup(num_clients=2)
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = lease_env(
+        request,
+        "standard-2-clients",
+        lambda: container_factory.getStandardSetup(num_clients=2),
+    )
 
     env.device_group = MenderDeviceGroup(env.get_mender_clients())
     env.device_group.ssh_is_opened()
@@ -114,10 +135,11 @@ def standard_setup_two_clients_bootstrapped(request):
 
 @pytest.fixture(scope="function")
 def standard_setup_without_client(request):
-    env = container_factory.getStandardSetup(num_clients=0)
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = lease_env(
+        request,
+        "standard-no-client",
+        lambda: container_factory.getStandardSetup(num_clients=0),
+    )
     reset_mender_api(env)
 
     return env
@@ -132,10 +154,9 @@ def setup_with_legacy_client(request):
             "Test only works with qemux86-64, and this is %s" % conftest.machine_name
         )
 
-    env = container_factory.getLegacyClientSetup()
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = lease_env(
+        request, "legacy-client", lambda: container_factory.getLegacyClientSetup()
+    )
 
     env.device = MenderDevice(env.get_mender_clients()[0])
     env.device.ssh_is_opened()
@@ -148,10 +169,11 @@ def setup_with_legacy_client(request):
 
 @pytest.fixture(scope="function")
 def standard_setup_with_signed_artifact_client(request):
-    env = container_factory.getSignedArtifactClientSetup()
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = lease_env(
+        request,
+        "signed-artifact-client",
+        lambda: container_factory.getSignedArtifactClientSetup(),
+    )
 
     env.device = MenderDevice(env.get_mender_clients()[0])
     env.device.ssh_is_opened()
@@ -165,10 +187,11 @@ def standard_setup_with_signed_artifact_client(request):
 
 @pytest.fixture(scope="function")
 def standard_setup_with_short_lived_token(request):
-    env = container_factory.getShortLivedTokenSetup()
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = lease_env(
+        request,
+        "short-lived-token",
+        lambda: container_factory.getShortLivedTokenSetup(),
+    )
 
     env.device = MenderDevice(env.get_mender_clients()[0])
     env.device.ssh_is_opened()
@@ -182,10 +205,14 @@ def standard_setup_with_short_lived_token(request):
 
 @pytest.fixture(scope="function")
 def setup_failover(request):
-    env = container_factory.getFailoverServerSetup()
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    # the second server has a database of its own, which reset() doesn't
+    # handle
+    env = lease_env(
+        request,
+        "failover-server",
+        lambda: container_factory.getFailoverServerSetup(),
+        pooled=False,
+    )
     reset_mender_api(env)
 
     env.device = MenderDevice(env.get_mender_clients()[0])
@@ -216,10 +243,11 @@ def running_custom_production_setup(request):
 
 @pytest.fixture(scope="function")
 def enterprise_no_client(request):
-    env = container_factory.getEnterpriseSetup(num_clients=0)
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = lease_env(
+        request,
+        "enterprise-no-client",
+        lambda: container_factory.getEnterpriseSetup(num_clients=0),
+    )
     reset_mender_api(env)
 
     return env
@@ -227,10 +255,9 @@ def enterprise_no_client(request):
 
 @pytest.fixture(scope="function")
 def enterprise_no_client_smtp(request):
-    env = container_factory.getEnterpriseSMTPSetup()
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = lease_env(
+        request, "enterprise-smtp", lambda: container_factory.getEnterpriseSMTPSetup()
+    )
     reset_mender_api(env)
 
     return env
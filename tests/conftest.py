@@ -24,6 +24,8 @@ import distutils.spawn
 from . import log
 from .tests.mendertesting import MenderTesting
 from testutils.infra.container_manager.base import BaseContainerManagerNamespace
+from testutils.infra.container_manager.docker_compose_manager import lock_wait_stats
+from testutils.infra.container_manager.pool import get_environment_pool
 from testutils.infra.device import MenderDevice, MenderDeviceGroup
 
 logging.getLogger("requests").setLevel(logging.CRITICAL)
@@ -101,6 +103,32 @@ except ImportError:
         logger.info("%s is starting.... " % test_name)
 
 
+@pytest.hookimpl(tryfirst=True, hookwrapper=True)
+def pytest_runtest_makereport(item, call):
+    # keep the reports of each phase on the item, see node_failed
+    outcome = yield
+    report = outcome.get_result()
+    setattr(item, "rep_" + report.when, report)
+
+
+def node_failed(node):
+    """Whether the setup or the call of a test failed, for the fixtures to
+    decide in their finalizers whether their environment can be reused."""
+    reports = [getattr(node, "rep_" + when, None) for when in ("setup", "call")]
+    return any(report is not None and report.failed for report in reports)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    pool = get_environment_pool()
+    pool.close()
+    logger.info("environment pool: %s" % pool.stats())
+    for name, (count, total, longest) in sorted(lock_wait_stats().items()):
+        logger.info(
+            "%s: acquired %d times, waited %.1fs in total, %.1fs at most"
+            % (name, count, total, longest)
+        )
+
+
 def pytest_exception_interact(node, call, report):
     if report.failed:
         logger.error(
@@ -23,6 +23,7 @@ usage() {
     echo
     echo "XDIST_PARALLEL_ARG                 The number of parallel jobs for pytest-xdist"
     echo "SPECIFIC_INTEGRATION_TEST          The ability to pass <testname-regexp> to pytest -k"
+    echo "INTEGRATION_ENV_POOL_SIZE          Number of idle test environments each pytest-xdist worker keeps for reuse (default: 1, 0 disables reuse)"
     exit 0
 }
 
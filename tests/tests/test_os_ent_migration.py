@@ -17,7 +17,13 @@ import json
 import requests
 import pytest
 
-from testutils.common import create_user, make_accepted_device, User, Tenant
+from testutils.common import (
+    create_user,
+    make_accepted_device,
+    DeviceDirectory,
+    User,
+    Tenant,
+)
 from testutils.api.client import ApiClient
 from testutils.infra.cli import CliTenantadm
 import testutils.api.deviceauth as deviceauth
@@ -109,8 +115,9 @@ def initialize_os_setup(env):
 
     # create and accept some devs; save tokens
     devs = []
+    directory = DeviceDirectory(dauthm, utoken)
     for _ in range(10):
-        devs.append(make_accepted_device(dauthd, dauthm, utoken))
+        devs.append(make_accepted_device(dauthd, dauthm, utoken, directory=directory))
 
     # get tokens for all
     for d in devs:
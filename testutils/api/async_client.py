@@ -0,0 +1,231 @@
+# Copyright 2020 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# asyncio counterpart of testutils.api.client.ApiClient, for driving many
+# concurrent calls (e.g. a simulated device fleet) from a single thread:
+#
+#   async with AsyncApiClient(deviceauth.URL_DEVICES) as devauthd:
+#       rsps = await asyncio.gather(
+#           *[devauthd.call("POST", deviceauth.URL_AUTH_REQS, b, headers=h)
+#             for b, h in reqs]
+#       )
+
+import asyncio
+import json
+import os
+
+import aiohttp
+
+from testutils.api.client import GATEWAY_HOSTNAME
+from testutils.infra.container_manager.kubernetes_manager import (
+    get_port_forward,
+    isK8S,
+)
+
+# Maximum number of requests in flight (and open connections) per pool.
+MAX_CONCURRENCY = int(os.environ.get("ASYNC_API_CLIENT_MAX_CONCURRENCY") or 100)
+# Default total timeout of a single request, in seconds.
+TIMEOUT = float(os.environ.get("ASYNC_API_CLIENT_TIMEOUT") or 60)
+
+
+class AsyncResponse:
+    """The parts of requests.Response the tests use, read eagerly so that
+    the connection is back in the pool when call() returns."""
+
+    def __init__(self, status_code, headers, content, url):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.url = url
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class AsyncPool:
+    """Connection pool and concurrency bound shared by AsyncApiClients.
+
+    The aiohttp session is bound to the running event loop, so it is created
+    on first use and must be closed from that same loop.
+    """
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, timeout=TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._session = None
+        self._semaphore = None
+
+    def _ensure(self):
+        """Creates the session and the semaphore bounding it, on first use
+        and again after close()."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency, ssl=False)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                cookie_jar=aiohttp.DummyCookieJar(),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    @property
+    def session(self):
+        self._ensure()
+        return self._session
+
+    @property
+    def semaphore(self):
+        self._ensure()
+        return self._semaphore
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncApiClient:
+    def __init__(
+        self, base_url="", host=GATEWAY_HOSTNAME, schema="https://", pool=None,
+    ):
+        """
+        :param pool: AsyncPool to share connections and the concurrency
+                     bound with other clients; by default the client owns
+                     a pool of its own.
+        """
+        self.host = host
+        self.schema = schema
+        self.base_url = schema + host + base_url
+        self.headers = {}
+        self.owns_pool = pool is None
+        self.pool = pool if pool is not None else AsyncPool()
+
+    def with_auth(self, token):
+        return self.with_header("Authorization", "Bearer " + token)
+
+    def with_header(self, hdr, val):
+        self.headers[hdr] = val
+        return self
+
+    async def call(
+        self,
+        method,
+        url,
+        body=None,
+        data=None,
+        path_params={},
+        qs_params={},
+        headers={},
+        auth=None,
+        files=None,
+        timeout=None,
+    ):
+        """Same as ApiClient.call, returning an AsyncResponse.
+
+        :param timeout: total timeout for this request in seconds,
+                        overriding the pool's default.
+        """
+        url = self.__make_url(url)
+        url = self.__subst_path_params(url, path_params)
+        if isK8S() and url.startswith("http://mender-"):
+            host = self.host.split(":", 1)[0]
+            port = self.host.split(":", 1)[1] if ":" in self.host else "80"
+            fwd = await asyncio.get_event_loop().run_in_executor(
+                None, get_port_forward, host, port
+            )
+            url = "http://localhost:%d/" % fwd.local_port + url.split("/", 3)[-1]
+        kwargs = {
+            "params": self.__make_params(qs_params),
+            "headers": self.__make_headers(headers),
+        }
+        if files is not None:
+            kwargs["data"] = self.__make_form(data, files)
+        elif body is not None:
+            kwargs["json"] = body
+        elif data is not None:
+            kwargs["data"] = data
+        if auth is not None:
+            kwargs["auth"] = aiohttp.BasicAuth(*auth)
+        if timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout)
+
+        async with self.pool.semaphore:
+            async with self.pool.session.request(method, url, **kwargs) as rsp:
+                content = await rsp.read()
+                return AsyncResponse(rsp.status, rsp.headers, content, str(rsp.url))
+
+    async def post(self, url, *pargs, **kwargs):
+        return await self.call("POST", url, *pargs, **kwargs)
+
+    async def close(self):
+        if self.owns_pool:
+            await self.pool.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def __make_url(self, path):
+        return os.path.join(
+            self.base_url, path if not path.startswith("/") else path[1:]
+        )
+
+    def __subst_path_params(self, url, path_params):
+        return url.format(**path_params)
+
+    def __make_headers(self, headers):
+        return dict(self.headers, **headers)
+
+    def __make_params(self, qs_params):
+        # Mimic requests: drop None values, repeat the key for list values and
+        # stringify the rest, aiohttp refuses anything but str/int/float.
+        if isinstance(qs_params, dict):
+            qs_params = qs_params.items()
+        params = []
+        for k, v in qs_params:
+            for item in v if isinstance(v, (list, tuple)) else [v]:
+                if item is not None:
+                    params.append((k, item if isinstance(item, str) else str(item)))
+        return params
+
+    def __make_form(self, data, files):
+        """Build a multipart form the way requests does for data= + files=.
+
+        files is a dict or a sequence of (name, value) pairs, value being
+        either the content or a (filename, content[, content_type]) tuple;
+        a None filename makes a plain form field.
+        """
+        form = aiohttp.FormData()
+        for name, value in (data or {}).items():
+            form.add_field(name, value if isinstance(value, str) else str(value))
+        if isinstance(files, dict):
+            files = files.items()
+        for name, value in files:
+            if isinstance(value, tuple):
+                filename, content = value[0], value[1]
+                content_type = value[2] if len(value) > 2 else None
+            else:
+                filename, content, content_type = name, value, None
+            if filename is None:
+                form.add_field(name, content, content_type=content_type)
+            else:
+                form.add_field(
+                    name, content, filename=filename, content_type=content_type
+                )
+        return form
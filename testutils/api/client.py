@@ -13,22 +13,126 @@
 #    limitations under the License.
 import os
 import os.path
-import subprocess
+import threading
+from http.cookiejar import DefaultCookiePolicy
 
 import requests
-import time
+from requests.adapters import HTTPAdapter
 
-from testutils.infra.container_manager.kubernetes_manager import isK8S
+from testutils.infra.container_manager.kubernetes_manager import (
+    get_port_forward,
+    isK8S,
+)
 
 GATEWAY_HOSTNAME = os.environ.get("GATEWAY_HOSTNAME") or "mender-api-gateway"
 
+# Maximum number of keep-alive connections kept open per host (and process).
+POOL_MAXSIZE = int(os.environ.get("API_CLIENT_POOL_MAXSIZE") or 32)
+
+
+class HostPool:
+    """Keep-alive connection pool shared by all ApiClients talking to a host.
+
+    The urllib3 pool behind the adapter is thread-safe while requests.Session
+    is not, so every thread gets its own session mounting the shared adapter.
+    """
+
+    def __init__(self, pool_maxsize=POOL_MAXSIZE):
+        self.adapter = HTTPAdapter(pool_maxsize=pool_maxsize)
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            # ApiClient has always been stateless; don't let cookies leak
+            # between clients sharing the pool.
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            session.mount("http://", self.adapter)
+            session.mount("https://", self.adapter)
+            self._local.session = session
+        return session
+
+    def stats(self):
+        """Returns connection reuse counters of the pool:
+        "connections" opened, "requests" sent and "reused" connections."""
+        connections = requests_sent = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            requests_sent += pool.num_requests
+        return {
+            "connections": connections,
+            "requests": requests_sent,
+            "reused": requests_sent - connections,
+        }
+
+    def close(self):
+        self.adapter.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_host_pool(schema, host, pool_maxsize=POOL_MAXSIZE):
+    """Returns the HostPool for schema+host, creating it on first use.
+
+    Pools are keyed by pid as well, so that connections are never shared
+    between forked processes (e.g. xdist workers).
+    """
+    key = (os.getpid(), schema + host, pool_maxsize)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = HostPool(pool_maxsize)
+            _pools[key] = pool
+        return pool
+
+
+def connection_stats():
+    """Returns the connection reuse counters of every pool in this process,
+    keyed by schema+host."""
+    stats = {}
+    with _pools_lock:
+        pools = [(k, p) for k, p in _pools.items() if k[0] == os.getpid()]
+    for (_, url, _), pool in pools:
+        total = stats.setdefault(url, {"connections": 0, "requests": 0, "reused": 0})
+        for counter, value in pool.stats().items():
+            total[counter] += value
+    return stats
+
+
+def close_pools():
+    """Closes all pooled connections held by this process."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
 
 class ApiClient:
-    def __init__(self, base_url="", host=GATEWAY_HOSTNAME, schema="https://"):
+    def __init__(
+        self,
+        base_url="",
+        host=GATEWAY_HOSTNAME,
+        schema="https://",
+        pool_maxsize=POOL_MAXSIZE,
+    ):
         self.host = host
         self.schema = schema
         self.base_url = schema + host + base_url
         self.headers = {}
+        self.pool = get_host_pool(schema, host, pool_maxsize)
+
+    def connection_stats(self):
+        """Returns the connection reuse counters of this client's host pool."""
+        return self.pool.stats()
 
     def with_auth(self, token):
         return self.with_header("Authorization", "Bearer " + token)
@@ -51,30 +155,22 @@ class ApiClient:
     ):
         url = self.__make_url(url)
         url = self.__subst_path_params(url, path_params)
-        try:
-            p = None
-            if isK8S() and url.startswith("http://mender-"):
-                host = self.host.split(":", 1)[0]
-                port = self.host.split(":", 1)[1] if ":" in self.host else "80"
-                cmd = ["kubectl", "port-forward", "service/" + host, "8080:%s" % port]
-                p = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
-                url = "http://localhost:8080/" + url.split("/", 3)[-1]
-                # wait a few seconds to let the port-forwarding fully initialize
-                time.sleep(3)
-            return requests.request(
-                method,
-                url,
-                json=body,
-                data=data,
-                params=qs_params,
-                headers=self.__make_headers(headers),
-                auth=auth,
-                verify=False,
-                files=files,
-            )
-        finally:
-            if p is not None:
-                p.terminate()
+        if isK8S() and url.startswith("http://mender-"):
+            host = self.host.split(":", 1)[0]
+            port = self.host.split(":", 1)[1] if ":" in self.host else "80"
+            fwd = get_port_forward(host, port)
+            url = "http://localhost:%d/" % fwd.local_port + url.split("/", 3)[-1]
+        return self.pool.session.request(
+            method,
+            url,
+            json=body,
+            data=data,
+            params=qs_params,
+            headers=self.__make_headers(headers),
+            auth=auth,
+            verify=False,
+            files=files,
+        )
 
     def post(self, url, *pargs, **kwargs):
         return self.call("POST", url, *pargs, **kwargs)
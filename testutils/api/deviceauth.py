@@ -51,3 +51,17 @@ def auth_req(id_data, pubkey, privkey, tenant_token=""):
     }
     signature = testutils.util.crypto.auth_req_sign(json.dumps(payload), privkey)
     return payload, {"X-MEN-Signature": signature}
+
+
+def auth_reqs(reqs):
+    """ Batch version of auth_req, signing across all cores.
+        reqs is a list of (id_data, pubkey, privkey, tenant_token) tuples.
+        returns list of (payload, headers) tuples."""
+    payloads = [
+        {"id_data": json.dumps(id_data), "tenant_token": tenant_token, "pubkey": pubkey}
+        for id_data, pubkey, _, tenant_token in reqs
+    ]
+    signatures = testutils.util.crypto.auth_req_sign_many(
+        [(json.dumps(p), req[2]) for p, req in zip(payloads, reqs)]
+    )
+    return [(p, {"X-MEN-Signature": sig}) for p, sig in zip(payloads, signatures)]
@@ -18,15 +18,17 @@ import time
 import string
 import tempfile
 import os
-import subprocess
-import redo
 import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import contextmanager
 
 import testutils.api.deviceauth as deviceauth
 import testutils.api.tenantadm as tenantadm
 import testutils.api.useradm as useradm
 import testutils.util.crypto
+from testutils.util.artifact import module_image, parse_key_values
+from testutils.util.wait import wait_until, WaitTimeout
 from testutils.api.client import ApiClient, GATEWAY_HOSTNAME
 from testutils.infra.mongo import MongoClient
 from testutils.infra.cli import CliUseradm, CliTenantadm
@@ -55,6 +57,7 @@ class User:
         self.name = name
         self.pwd = pwd
         self.id = id
+        self.token = None
 
 
 class Authset:
@@ -86,16 +89,20 @@ class Tenant:
         self.tenant_token = token
 
 
-def create_random_authset(dauthd1, dauthm, utoken, tenant_token=""):
+def create_random_authset(dauthd1, dauthm, utoken, tenant_token="", directory=None):
     """ create_device with random id data and keypair"""
     priv, pub = testutils.util.crypto.get_keypair_rsa()
     mac = ":".join(["{:02x}".format(random.randint(0x00, 0xFF), "x") for i in range(6)])
     id_data = {"mac": mac}
 
-    return create_authset(dauthd1, dauthm, id_data, pub, priv, utoken, tenant_token)
+    return create_authset(
+        dauthd1, dauthm, id_data, pub, priv, utoken, tenant_token, directory
+    )
 
 
-def create_authset(dauthd1, dauthm, id_data, pubkey, privkey, utoken, tenant_token=""):
+def create_authset(
+    dauthd1, dauthm, id_data, pubkey, privkey, utoken, tenant_token="", directory=None
+):
     body, sighdr = deviceauth.auth_req(id_data, pubkey, privkey, tenant_token)
 
     # submit auth req
@@ -103,15 +110,13 @@ def create_authset(dauthd1, dauthm, id_data, pubkey, privkey, utoken, tenant_tok
     assert r.status_code == 401, r.text
 
     # dev must exist and have *this* aset
-    api_dev = get_device_by_id_data(dauthm, id_data, utoken)
-    assert api_dev is not None
+    if directory is None:
+        directory = DeviceDirectory(dauthm, utoken)
+    api_dev = directory.get_many([id_data], [pubkey])[0]
+    assert api_dev is not None, "device not found by id data"
 
-    aset = [
-        a
-        for a in api_dev["auth_sets"]
-        if testutils.util.crypto.compare_keys(a["pubkey"], pubkey)
-    ]
-    assert len(aset) == 1, str(aset)
+    aset = directory.authsets(api_dev, pubkey)
+    assert len(aset) == 1, str(api_dev["auth_sets"])
 
     aset = aset[0]
 
@@ -140,25 +145,64 @@ def create_org(
     cli = CliTenantadm(
         containers_namespace=containers_namespace, container_manager=container_manager
     )
-    user_id = None
-    tenant_id = cli.create_org(name, username, password, plan=plan)
-    tenant_token = json.loads(cli.get_tenant(tenant_id))["tenant_token"]
 
     host = GATEWAY_HOSTNAME
     if container_manager is not None:
         host = container_manager.get_mender_gateway()
+
+    return _create_org(cli, host, name, username, password, plan)
+
+
+def create_orgs(
+    specs, containers_namespace="backend-tests", container_manager=None, concurrency=8,
+):
+    """ Create many organizations, running up to `concurrency` container
+        execs and logins at a time.
+        specs is a list of dicts with the name, username, password and
+        (optionally) plan of each organization.
+        returns list of Tenant objects, in the order of specs."""
+    cli = CliTenantadm(
+        containers_namespace=containers_namespace, container_manager=container_manager
+    )
+
+    host = GATEWAY_HOSTNAME
+    if container_manager is not None:
+        host = container_manager.get_mender_gateway()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [
+            pool.submit(
+                _create_org,
+                cli,
+                host,
+                spec["name"],
+                spec["username"],
+                spec["password"],
+                spec.get("plan", "os"),
+            )
+            for spec in specs
+        ]
+        return [fut.result() for fut in futures]
+
+
+def _create_org(cli, host, name, username, password, plan):
+    user_id = None
+    tenant_id = cli.create_org(name, username, password, plan=plan)
+    tenant_token = json.loads(cli.get_tenant(tenant_id))["tenant_token"]
+
     api = ApiClient(useradm.URL_MGMT, host=host)
 
-    # Try log in every second for 3 minutes.
+    # Try log in for 3 minutes.
     # - There usually is a slight delay (in order of ms) for propagating
     #   the created user to the db.
-    for i in range(3 * 60):
-        rsp = api.call("POST", useradm.URL_LOGIN, auth=(username, password))
-        if rsp.status_code == 200:
-            break
-        time.sleep(1)
-
-    if rsp.status_code != 200:
+    try:
+        rsp = wait_until(
+            lambda: api.call("POST", useradm.URL_LOGIN, auth=(username, password)),
+            timeout=3 * 60,
+            ready=lambda rsp: rsp.status_code == 200,
+            name="create_org login",
+        )
+    except WaitTimeout:
         raise ValueError(
             "User could not log in within three minutes after organization has been created."
         )
@@ -175,35 +219,166 @@ def create_org(
 
     tenant = Tenant(name, tenant_id, tenant_token)
     user = User(user_id, username, password)
+    user.token = user_token
     tenant.users.append(user)
     return tenant
 
 
-def get_device_by_id_data(dauthm, id_data, utoken):
-    page = 0
-    per_page = 20
-    qs_params = {}
-    found = None
-    while True:
-        page = page + 1
-        qs_params["page"] = page
-        qs_params["per_page"] = per_page
-        r = dauthm.with_auth(utoken).call(
+def _id_data_key(id_data):
+    return json.dumps(id_data, sort_keys=True)
+
+
+class DeviceDirectory:
+    """ Index of identity_data -> api device over the devauth device list,
+        of the devices one user token sees. Create one per user (e.g. in
+        the fixture creating the devices) and pass it to the helpers here.
+
+        The index is built with large pages and refreshed incrementally:
+        new devices are searched for from the last (partial) page seen
+        onwards, then among the pending devices only, and only as a last
+        resort by rebuilding the whole index. Lookups return the devices
+        as listed; a device is fetched by id only when it lacks an auth set
+        the caller expects, and re-resolved when it is gone. Each identity
+        must map to exactly one device.
+        The auth sets of the devices looked up are indexed by public key
+        fingerprint, see authsets()."""
+
+    PER_PAGE = 500
+
+    def __init__(self, dauthm, utoken, per_page=PER_PAGE):
+        self.dauthm = dauthm
+        self.utoken = utoken
+        self.per_page = per_page
+        self._index = {}
+        # device id -> (api device, fingerprint -> list of its auth sets)
+        self._fingerprints = {}
+        # number of devices scanned in the unfiltered listing
+        self._scanned = 0
+        self._lock = threading.Lock()
+
+    def _list(self, page, status=None):
+        qs_params = {"page": page, "per_page": self.per_page}
+        if status is not None:
+            qs_params["status"] = status
+        r = self.dauthm.with_auth(self.utoken).call(
             "GET", deviceauth.URL_MGMT_DEVICES, qs_params=qs_params
         )
         assert r.status_code == 200
-        api_devs = r.json()
-
-        found = [d for d in api_devs if d["identity_data"] == id_data]
-        if len(found) > 0:
-            break
-
-        if len(api_devs) == 0:
-            break
-
-    assert len(found) == 1, "device not found by id data"
-
-    return found[0]
+        return r.json()
+
+    def _scan(self, page, status=None):
+        """ Index every device from page onwards, returns the number of
+            devices listed."""
+        listed = 0
+        while True:
+            api_devs = self._list(page, status)
+            for d in api_devs:
+                found = self._index.setdefault(_id_data_key(d["identity_data"]), {})
+                found[d["id"]] = d
+            listed += len(api_devs)
+            if len(api_devs) == 0:
+                return listed
+            page = page + 1
+
+    def _refresh(self, keys):
+        """ Refresh the index until all of keys are found, cheapest first."""
+        # newer pages only: re-read the last partial page and what follows
+        first_page = self._scanned // self.per_page + 1
+        listed = self._scan(first_page)
+        self._scanned = (first_page - 1) * self.per_page + listed
+        if all(k in self._index for k in keys):
+            return
+
+        # fresh auth sets are pending, so is their device
+        self._scan(1, status="pending")
+        if all(k in self._index for k in keys):
+            return
+
+        self._rebuild()
+
+    def _rebuild(self):
+        self._index = {}
+        self._fingerprints = {}
+        self._scanned = self._scan(1)
+
+    def _device(self, key):
+        """ returns the one device indexed under key (None if none)."""
+        found = self._index.get(key, {})
+        if len(found) > 1:
+            # maybe a device removed since it was indexed, look again
+            self._rebuild()
+            found = self._index.get(key, {})
+        assert len(found) <= 1, "id data matches devices %s" % list(found)
+        return next(iter(found.values()), None)
+
+    def _fetch(self, did):
+        r = self.dauthm.with_auth(self.utoken).call(
+            "GET", deviceauth.URL_DEVICE, path_params={"id": did}
+        )
+        if r.status_code == 404:
+            return None
+        assert r.status_code == 200
+        return r.json()
+
+    def get_many(self, id_datas, pubkeys=None):
+        """ returns list of api devices (None if not found), in the order of
+            id_datas. pubkeys are the keys (or None) whose auth set each
+            device is expected to have, in the same order; a listed device
+            without it is fetched anew."""
+        keys = [_id_data_key(id_data) for id_data in id_datas]
+        if pubkeys is None:
+            pubkeys = [None] * len(keys)
+        with self._lock:
+            if not all(k in self._index for k in keys):
+                self._refresh(keys)
+            listed = [self._device(k) for k in keys]
+
+        devices = []
+        for key, pubkey, dev in zip(keys, pubkeys, listed):
+            if (
+                dev is not None
+                and pubkey is not None
+                and not self.authsets(dev, pubkey)
+            ):
+                dev = self._fetch(dev["id"])
+                if dev is not None and _id_data_key(dev["identity_data"]) != key:
+                    dev = None
+                with self._lock:
+                    if dev is None:
+                        # stale entry (e.g. db cleaned up in between), reindex
+                        self._index.pop(key, None)
+                        self._refresh([key])
+                        dev = self._device(key)
+                    else:
+                        self._index[key] = {dev["id"]: dev}
+            devices.append(dev)
+        return devices
+
+    def get(self, id_data):
+        return self.get_many([id_data])[0]
+
+    def authsets(self, api_dev, pubkey):
+        """ returns the list of auth sets of api_dev (as returned by the
+            lookups) with pubkey."""
+        with self._lock:
+            indexed, asets = self._fingerprints.get(api_dev["id"], (None, None))
+            if indexed is not api_dev:
+                asets = {}
+                for a in api_dev["auth_sets"]:
+                    fingerprint = testutils.util.crypto.pubkey_fingerprint(a["pubkey"])
+                    asets.setdefault(fingerprint, []).append(a)
+                self._fingerprints[api_dev["id"]] = (api_dev, asets)
+        return asets.get(testutils.util.crypto.pubkey_fingerprint(pubkey), [])
+
+
+def get_device_by_id_data(dauthm, id_data, utoken, directory=None):
+    if directory is None:
+        directory = DeviceDirectory(dauthm, utoken)
+    found = directory.get(id_data)
+
+    assert found is not None, "device not found by id data"
+
+    return found
 
 
 def change_authset_status(dauthm, did, aid, status, utoken):
@@ -223,12 +398,19 @@ def rand_id_data():
     return {"mac": mac, "sn": sn}
 
 
-def make_pending_device(dauthd1, dauthm, utoken, tenant_token=""):
+def make_pending_device(dauthd1, dauthm, utoken, tenant_token="", directory=None):
     id_data = rand_id_data()
 
     priv, pub = testutils.util.crypto.get_keypair_rsa()
     new_set = create_authset(
-        dauthd1, dauthm, id_data, pub, priv, utoken, tenant_token=tenant_token
+        dauthd1,
+        dauthm,
+        id_data,
+        pub,
+        priv,
+        utoken,
+        tenant_token=tenant_token,
+        directory=directory,
     )
 
     dev = Device(new_set.did, new_set.id_data, pub, tenant_token)
@@ -240,8 +422,10 @@ def make_pending_device(dauthd1, dauthm, utoken, tenant_token=""):
     return dev
 
 
-def make_accepted_device(dauthd1, dauthm, utoken, tenant_token=""):
-    dev = make_pending_device(dauthd1, dauthm, utoken, tenant_token=tenant_token)
+def make_accepted_device(dauthd1, dauthm, utoken, tenant_token="", directory=None):
+    dev = make_pending_device(
+        dauthd1, dauthm, utoken, tenant_token=tenant_token, directory=directory
+    )
     aset_id = dev.authsets[0].id
     change_authset_status(dauthm, dev.id, aset_id, "accepted", utoken)
 
@@ -263,17 +447,131 @@ def make_accepted_device(dauthd1, dauthm, utoken, tenant_token=""):
     return dev
 
 
-def make_accepted_devices(devauthd, devauthm, utoken, tenant_token="", num_devices=1):
-    """ Create accepted devices.
-        returns list of Device objects."""
-    devices = []
+class DeviceProvisioner:
+    """ Creates accepted devices in a pipeline:
+
+        keygen + auth_req -> lookup -> accept + auth_token
+
+        The per-device stages run on a thread pool of `concurrency` workers,
+        devices are looked up in batches of `batch_size` as their auth
+        requests complete, so one batch is accepted while the next one is
+        still being submitted.
+        After each run `timings` holds the time spent in each stage (summed
+        over the workers) and the total wall time."""
 
-    # some 'accepted' devices, single authset
-    for _ in range(num_devices):
-        dev = make_accepted_device(devauthd, devauthm, utoken, tenant_token)
-        devices.append(dev)
+    STAGES = ("keygen", "auth_req", "lookup", "accept", "auth_token")
 
-    return devices
+    def __init__(
+        self, devauthd, devauthm, utoken, tenant_token="", concurrency=8, batch_size=50
+    ):
+        self.devauthd = devauthd
+        self.devauthm = devauthm
+        self.utoken = utoken
+        self.tenant_token = tenant_token
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        # index of the devices looked up, lives as long as the provisioner
+        self.directory = DeviceDirectory(devauthm, utoken)
+        self.timings = {}
+        self._timings_lock = threading.Lock()
+
+    @contextmanager
+    def _timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._timings_lock:
+                self.timings[stage] = self.timings.get(stage, 0.0) + elapsed
+
+    def _submit_auth_req(self, id_data):
+        with self._timed("keygen"):
+            priv, pub = testutils.util.crypto.get_keypair_rsa()
+        with self._timed("auth_req"):
+            body, sighdr = deviceauth.auth_req(id_data, pub, priv, self.tenant_token)
+            r = self.devauthd.call(
+                "POST", deviceauth.URL_AUTH_REQS, body, headers=sighdr
+            )
+        assert r.status_code == 401, r.text
+        return id_data, pub, priv
+
+    def _lookup(self, submitted):
+        with self._timed("lookup"):
+            api_devs = self.directory.get_many(
+                [id_data for id_data, _, _ in submitted],
+                [pub for _, pub, _ in submitted],
+            )
+        devices = []
+        for (id_data, pub, priv), api_dev in zip(submitted, api_devs):
+            assert api_dev is not None, "device not found by id data"
+            aset = self.directory.authsets(api_dev, pub)
+            assert len(aset) == 1, str(api_dev["auth_sets"])
+            aset = aset[0]
+            assert aset["identity_data"] == id_data
+            assert aset["status"] == "pending"
+
+            dev = Device(api_dev["id"], id_data, pub, self.tenant_token)
+            dev.authsets.append(
+                Authset(aset["id"], api_dev["id"], id_data, pub, priv, "pending")
+            )
+            dev.status = "pending"
+            devices.append(dev)
+        return devices
+
+    def _accept(self, dev):
+        aset = dev.authsets[0]
+        with self._timed("accept"):
+            change_authset_status(
+                self.devauthm, dev.id, aset.id, "accepted", self.utoken
+            )
+        aset.status = "accepted"
+
+        with self._timed("auth_token"):
+            body, sighdr = deviceauth.auth_req(
+                aset.id_data, aset.pubkey, aset.privkey, self.tenant_token
+            )
+            r = self.devauthd.call(
+                "POST", deviceauth.URL_AUTH_REQS, body, headers=sighdr
+            )
+        assert r.status_code == 200
+        dev.token = r.text
+        dev.status = "accepted"
+        return dev
+
+    def make_accepted_devices(self, num_devices):
+        """ returns list of num_devices accepted Device objects."""
+        self.timings = {}
+        start = time.perf_counter()
+        devices = []
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            submits = [
+                pool.submit(self._submit_auth_req, rand_id_data())
+                for _ in range(num_devices)
+            ]
+            accepts = []
+            batch = []
+            for i, fut in enumerate(as_completed(submits)):
+                batch.append(fut.result())
+                if len(batch) == self.batch_size or i == num_devices - 1:
+                    for dev in self._lookup(batch):
+                        accepts.append(pool.submit(self._accept, dev))
+                    batch = []
+            for fut in as_completed(accepts):
+                devices.append(fut.result())
+        self.timings["total"] = time.perf_counter() - start
+        return devices
+
+
+def make_accepted_devices(
+    devauthd, devauthm, utoken, tenant_token="", num_devices=1, concurrency=8
+):
+    """ Create accepted devices.
+        returns list of Device objects."""
+    provisioner = DeviceProvisioner(
+        devauthd, devauthm, utoken, tenant_token, concurrency=concurrency
+    )
+    return provisioner.make_accepted_devices(num_devices)
 
 
 @contextmanager
@@ -285,38 +583,25 @@ def get_mender_artifact(
     depends=(),
     provides=(),
 ):
+    """ Builds a module-image artifact with a random payload of size bytes,
+    as `mender-artifact write module-image` would, and yields its path."""
     data = "".join(random.choices(string.ascii_uppercase + string.digits, k=size))
-    f = tempfile.NamedTemporaryFile(delete=False)
-    f.write(data.encode("utf-8"))
-    f.close()
-    #
-    filename = f.name
-    artifact = "%s.mender" % filename
-    args = [
-        "mender-artifact",
-        "write",
-        "module-image",
-        "-o",
-        artifact,
-        "--artifact-name",
+    artifact = module_image(
         artifact_name,
-        "-T",
+        device_types,
+        data,
         update_module,
-        "-f",
-        filename,
-    ]
-    for device_type in device_types:
-        args.extend(["-t", device_type])
-    for depend in depends:
-        args.extend(["--depends", depend])
-    for provide in provides:
-        args.extend(["--provides", provide])
+        depends=parse_key_values(depends),
+        provides=parse_key_values(provides),
+        name="payload",
+    )
+    f = tempfile.NamedTemporaryFile(suffix=".mender", delete=False)
     try:
-        subprocess.call(args)
-        yield artifact
+        with f:
+            artifact.write(f)
+        yield f.name
     finally:
-        os.unlink(filename)
-        os.path.exists(artifact) and os.unlink(artifact)
+        os.unlink(f.name)
 
 
 def wait_for_traefik(gateway_host, routers=[]):
@@ -343,16 +628,22 @@ def wait_for_traefik(gateway_host, routers=[]):
     else:
         rnames = routers[:]
 
-    for _ in redo.retrier(attempts=5, sleeptime=10):
-        try:
-            r = requests.get("http://{}:8080/api/http/routers".format(gateway_host))
-            assert r.status_code == 200
+    def routers_installed():
+        r = requests.get("http://{}:8080/api/http/routers".format(gateway_host))
+        assert r.status_code == 200
 
-            cur_routers = [x["name"] for x in r.json()]
+        cur_routers = [x["name"] for x in r.json()]
 
-            if set(cur_routers).issuperset(set(rnames)):
-                break
-        except requests.exceptions.ConnectionError as ex:
-            print("connection error while waiting for routers - but that's ok")
-    else:
+        return set(cur_routers).issuperset(set(rnames))
+
+    try:
+        # as long as the former redo.retrier(attempts=5, sleeptime=10) with
+        # its 1.5 sleepscale: 10 + 15 + 22.5 + 33.75s
+        wait_until(
+            routers_installed,
+            timeout=81.25,
+            ignore=(requests.exceptions.ConnectionError,),
+            name="wait_for_traefik",
+        )
+    except WaitTimeout:
         assert False, "timeout hit waiting for traefik routers {}".format(rnames)
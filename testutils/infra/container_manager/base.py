@@ -40,6 +40,12 @@ class BaseContainerManagerNamespace:
         """
         raise NotImplementedError
 
+    def reset(self):
+        """Brings the running containers back to their state after setup,
+        for reuse by another test
+        """
+        raise NotImplementedError
+
     def execute(self, container_id, cmd):
         """Executes the given cmd on an specific container
         """
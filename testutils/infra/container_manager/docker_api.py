@@ -0,0 +1,214 @@
+# Copyright 2020 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Minimal Docker Engine API client, talking HTTP over the daemon's unix
+# socket (or DOCKER_HOST) with one keep-alive connection per thread, so that
+# topology queries cost a local round-trip instead of spawning docker CLIs.
+
+import http.client
+import json
+import os
+import socket
+import threading
+from urllib.parse import quote, urlencode, urlparse
+
+DOCKER_HOST = os.environ.get("DOCKER_HOST") or "unix:///var/run/docker.sock"
+TIMEOUT = 60
+
+
+class DockerEngineError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, "docker engine: %d: %s" % (status, message))
+        self.status = status
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        http.client.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self._path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self._path)
+        self.sock = sock
+
+
+class DockerEngine:
+    def __init__(self, host=DOCKER_HOST, timeout=TIMEOUT):
+        self.host = host
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _new_connection(self):
+        url = urlparse(self.host)
+        if url.scheme == "unix":
+            return _UnixHTTPConnection(url.path, self.timeout)
+        return http.client.HTTPConnection(url.netloc, timeout=self.timeout)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._new_connection()
+            self._local.conn = conn
+        return conn
+
+    def request(self, method, path, params=None, body=None):
+        """Calls the API, returns the decoded JSON response (None if empty).
+        Raises DockerEngineError on error statuses."""
+        if params:
+            path += "?" + urlencode(params)
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        for attempt in (1, 2):
+            conn = self._connection()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                rsp = conn.getresponse()
+                data = rsp.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # the daemon closed the idle keep-alive connection, retry once
+                # on a fresh one
+                conn.close()
+                self._local.conn = None
+                if attempt == 2:
+                    raise
+        if rsp.status >= 400:
+            raise _error(rsp.status, data)
+        return json.loads(data) if data else None
+
+    def containers(self, all=False, **filters):
+        """Lists containers, e.g. containers(label=["a=b"], name=["c"]).
+        The summaries include labels, state and network settings (IPs and
+        gateways), so most queries need no inspect."""
+        params = {"all": "1" if all else "0"}
+        if filters:
+            params["filters"] = json.dumps(filters)
+        return self.request("GET", "/containers/json", params)
+
+    def inspect(self, container):
+        return self.request("GET", "/containers/%s/json" % quote(container, safe=""))
+
+    def inspect_many(self, containers):
+        """Inspects several containers over the same connection, skipping
+        the ones which are gone."""
+        result = []
+        for container in containers:
+            try:
+                result.append(self.inspect(container))
+            except DockerEngineError as e:
+                if e.status != 404:
+                    raise
+        return result
+
+    def remove_container(self, container, force=True, volumes=True):
+        try:
+            self.request(
+                "DELETE",
+                "/containers/%s" % quote(container, safe=""),
+                {"force": int(force), "v": int(volumes)},
+            )
+        except DockerEngineError as e:
+            if e.status != 404:
+                raise
+
+    def events(self, **filters):
+        """Subscribes to the daemon's events, e.g. events(type=["container"]),
+        on a connection of its own. The subscription is active when this
+        returns; iterate the returned EventStream for the decoded events."""
+        conn = self._new_connection()
+        path = "/events"
+        if filters:
+            path += "?" + urlencode({"filters": json.dumps(filters)})
+        try:
+            conn.request("GET", path)
+            rsp = conn.getresponse()
+            if rsp.status >= 400:
+                raise _error(rsp.status, rsp.read())
+        except Exception:
+            conn.close()
+            raise
+        # events may be far apart, block until the next one or close()
+        conn.sock.settimeout(None)
+        return EventStream(conn, rsp)
+
+    def networks(self, **filters):
+        params = {"filters": json.dumps(filters)} if filters else None
+        return self.request("GET", "/networks", params)
+
+    def remove_network(self, network):
+        try:
+            self.request("DELETE", "/networks/%s" % quote(network, safe=""))
+        except DockerEngineError as e:
+            if e.status != 404:
+                raise
+
+
+class EventStream:
+    def __init__(self, conn, rsp):
+        self._conn = conn
+        self._rsp = rsp
+
+    def __iter__(self):
+        # the daemon writes one JSON object per line
+        for line in self._rsp:
+            if line.strip():
+                yield json.loads(line)
+
+    def close(self):
+        """Ends the subscription, also waking up a thread iterating it."""
+        sock = self._conn.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._conn.close()
+
+
+def _error(status, data):
+    try:
+        message = json.loads(data)["message"]
+    except (ValueError, KeyError):
+        message = data.decode(errors="replace")
+    return DockerEngineError(status, message)
+
+
+def ps_line(container):
+    """Text of a container summary as in `docker ps`, to match the grep
+    patterns the namespaces used to filter `docker ps` output with."""
+    return " ".join(
+        [
+            container["Id"][:12],
+            container["Image"],
+            container.get("Command", ""),
+            container.get("Status", ""),
+        ]
+        + [name.lstrip("/") for name in container.get("Names", [])]
+    )
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_docker_engine():
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = DockerEngine()
+        return _engine
@@ -16,16 +16,160 @@ import re
 import time
 import socket
 import subprocess
+import tempfile
+import threading
 import filelock
 import logging
 import copy
 
+import requests
+
+from testutils.util.wait import wait_until, WaitTimeout
+from .docker_api import get_docker_engine, ps_line
 from .docker_manager import DockerNamespace
 
 logger = logging.getLogger("root")
 
-# Global lock to sycronize calls to docker-compose
-docker_lock = filelock.FileLock("docker_lock")
+_lock_waits = {}
+_lock_waits_lock = threading.Lock()
+
+
+class TimedFileLock:
+    """filelock.FileLock recording how long each acquisition waited,
+    see lock_wait_stats."""
+
+    def __init__(self, path, name):
+        self.name = name
+        self._lock = filelock.FileLock(path)
+
+    def __enter__(self):
+        start = time.monotonic()
+        self._lock.acquire()
+        waited = time.monotonic() - start
+        with _lock_waits_lock:
+            _lock_waits.setdefault(self.name, []).append(waited)
+        if waited >= 1:
+            logger.info(
+                "worker %s waited %.1fs for %s"
+                % (os.environ.get("PYTEST_XDIST_WORKER", "master"), waited, self.name)
+            )
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._lock.release()
+
+
+def lock_wait_stats():
+    """Returns {lock name: (acquisitions, total wait, max wait)} of this
+    process (i.e. xdist worker)."""
+    with _lock_waits_lock:
+        return {
+            name: (len(waits), sum(waits), max(waits))
+            for name, waits in _lock_waits.items()
+        }
+
+
+# Global lock for the docker resources shared by all namespaces: pulling
+# images and creating networks/volumes/containers (docker-compose up
+# --no-start). Everything else only takes the lock of its namespace, so that
+# independent namespaces start and stop concurrently.
+docker_lock = TimedFileLock("docker_lock", "docker_lock")
+
+
+class ServiceTopology:
+    """Running containers of a docker-compose project, {service: [IP on the
+    mender network, ...]}, kept in memory.
+
+    The topology is listed once and kept while a subscription to the
+    project's container events is open; any event which can change it
+    (start, restart, die, destroy) drops it, and so do the namespace's
+    own docker-compose commands, which don't wait for the event. Without a
+    subscription every lookup lists the containers.
+    """
+
+    EVENTS = ("start", "restart", "die", "destroy")
+
+    def __init__(self, project):
+        self.project = project
+        self.network = "%s_mender" % project
+        self._lock = threading.Lock()
+        self._services = None
+        self._generation = 0
+        self._stream = None
+
+    def ips(self, service):
+        return list(self.services().get(service, []))
+
+    def services(self):
+        with self._lock:
+            if self._services is not None:
+                return self._services
+            if self._stream is None:
+                self._subscribe()
+            generation = self._generation
+            subscribed = self._stream is not None
+
+        services = {}
+        for container in get_docker_engine().containers(
+            label=["com.docker.compose.project=%s" % self.project]
+        ):
+            service = container["Labels"]["com.docker.compose.service"]
+            ips = services.setdefault(service, [])
+            network = container["NetworkSettings"]["Networks"].get(self.network)
+            if network and network["IPAddress"]:
+                ips.append(network["IPAddress"])
+
+        with self._lock:
+            # keep it unless it changed while listing
+            if subscribed and generation == self._generation:
+                self._services = services
+        return services
+
+    def invalidate(self):
+        with self._lock:
+            self._services = None
+            self._generation += 1
+
+    def close(self):
+        """Ends the events subscription (restarted on the next lookup)."""
+        with self._lock:
+            stream, self._stream = self._stream, None
+            self._services = None
+            self._generation += 1
+        if stream is not None:
+            stream.close()
+
+    def _subscribe(self):
+        try:
+            stream = get_docker_engine().events(
+                type=["container"],
+                label=["com.docker.compose.project=%s" % self.project],
+            )
+        except Exception as e:
+            logger.info("%s: not caching the topology: %s" % (self.project, e))
+            return
+        self._stream = stream
+        threading.Thread(
+            target=self._watch,
+            args=(stream,),
+            name="topology-%s" % self.project,
+            daemon=True,
+        ).start()
+
+    def _watch(self, stream):
+        try:
+            for event in stream:
+                if event.get("Action", "").split(":")[0] in self.EVENTS:
+                    self.invalidate()
+        except Exception as e:
+            logger.debug("%s: events stream ended: %s" % (self.project, e))
+        finally:
+            with self._lock:
+                if self._stream is stream:
+                    self._stream = None
+                    self._services = None
+                    self._generation += 1
+            stream.close()
 
 
 class DockerComposeNamespace(DockerNamespace):
@@ -97,9 +241,34 @@ class DockerComposeNamespace(DockerNamespace):
     NUM_SERVICES_OPENSOURCE = 12
     NUM_SERVICES_ENTERPRISE = 14
 
+    # Health endpoints (on port 8080) of the backend services, a service is
+    # ready once they answer 2xx.
+    HEALTH_ENDPOINTS = {
+        "mender-workflows-server": "/api/v1/health",
+        "mender-inventory": "/api/internal/v1/inventory/health",
+        "mender-deployments": "/api/internal/v1/deployments/health",
+        "mender-device-auth": "/api/internal/v1/devauth/health",
+        "mender-useradm": "/api/internal/v1/useradm/health",
+        "mender-tenantadm": "/api/internal/v1/tenantadm/health",
+    }
+
+    # services without a migrate CLI here, which migrate their database
+    # when they start (server --automigrate); reset() restarts them
+    AUTOMIGRATE_SERVICES = (
+        "mender-auditlogs",
+        "mender-deviceconnect",
+        "mender-inventory",
+    )
+
     def __init__(self, name, extra_files=[]):
         DockerNamespace.__init__(self, name)
         self.extra_files = copy.copy(extra_files)
+        self._setup_files = copy.copy(extra_files)
+        self.lock = TimedFileLock(
+            os.path.join(tempfile.gettempdir(), "docker_lock_%s" % self.name),
+            "docker_lock_%s" % self.name,
+        )
+        self.topology = ServiceTopology(self.name)
 
     @property
     def docker_compose_files(self):
@@ -112,12 +281,12 @@ class DockerComposeNamespace(DockerNamespace):
         """
         files_args = "".join([" -f %s" % file for file in self.docker_compose_files])
 
-        cmd = "MENDER_TESTPREFIX=%s docker-compose -p %s %s %s" % (
+        base_cmd = "MENDER_TESTPREFIX=%s docker-compose -p %s %s" % (
             self.name,
             self.name,
             files_args,
-            arg_list,
         )
+        cmd = "%s %s" % (base_cmd, arg_list)
 
         logger.info("running with: %s" % cmd)
 
@@ -125,9 +294,27 @@ class DockerComposeNamespace(DockerNamespace):
         if env:
             penv.update(env)
 
+        # "up" pulls images and creates the shared resources under the
+        # global lock first, then only starts the containers.
+        args = arg_list.split()
+        prepare_cmd = None
+        if args and args[0] == "up":
+            prepare_cmd = "%s up --no-start %s" % (
+                base_cmd,
+                " ".join([a for a in args[1:] if a != "-d"]),
+            )
+
         for count in range(1, 6):
-            with docker_lock:
+            with self.lock:
                 try:
+                    if prepare_cmd is not None:
+                        with docker_lock:
+                            subprocess.check_output(
+                                prepare_cmd,
+                                stderr=subprocess.STDOUT,
+                                shell=True,
+                                env=penv,
+                            )
                     return subprocess.check_output(
                         cmd, stderr=subprocess.STDOUT, shell=True, env=penv
                     ).decode("utf-8")
@@ -137,6 +324,8 @@ class DockerComposeNamespace(DockerNamespace):
                         'failed to run "%s": error follows:\n%s' % (cmd, e.output)
                     )
                     self._stop_docker_compose()
+                finally:
+                    self.topology.invalidate()
 
             if count < 5:
                 logger.info("sleeping %d seconds and retrying" % (count * 30))
@@ -144,40 +333,147 @@ class DockerComposeNamespace(DockerNamespace):
 
         raise Exception("failed to start docker-compose (called: %s)" % cmd)
 
-    def _wait_for_containers(self, expected_containers):
-        files_args = "".join([" -f %s" % file for file in self.docker_compose_files])
-        running_countainers_count = 0
-        for _ in range(60 * 5):
-            out = subprocess.check_output(
-                "docker-compose -p %s %s ps -q" % (self.name, files_args), shell=True
+    def _wait_for_containers(self, expected_containers, timeout=300):
+        """Waits until the namespace runs expected_containers containers and
+        each service is ready: its containers are running (and healthy, if
+        they have a health check), its health endpoint answers, and traefik
+        has registered its routers. Logs how long each service took.
+        """
+        start = time.monotonic()
+        deadline = start + timeout
+
+        def containers_created():
+            return [
+                container["Id"]
+                for container in self._containers(
+                    all=True, labels=["com.docker.compose.oneoff=False"]
+                )
+            ]
+
+        try:
+            ids = wait_until(
+                containers_created,
+                timeout,
+                ready=lambda ids: len(ids) == expected_containers,
+                name="%s: containers" % self.name,
+            )
+        except WaitTimeout as e:
+            logger.info(
+                "%s: running countainers mismatch, list of currently running: %s"
+                % (self.name, e.last)
+            )
+            raise Exception(
+                "timeout: running containers count: %d, expected: %d for docker-compose project: %s"
+                % (len(e.last or []), expected_containers, self.name)
             )
-            running_countainers_count = len(out.split())
-            if running_countainers_count == expected_containers:
-                time.sleep(60)
-                return
-            else:
-                time.sleep(1)
-        logger.info(
-            "%s: running countainers mismatch, list of currently running: %s"
-            % (self.name, out)
-        )
-        raise Exception(
-            "timeout: running containers count: %d, expected: %d for docker-compose project: %s"
-            % (running_countainers_count, expected_containers, self.name)
-        )
+
+        ready = {}
+        waiting = {}
+
+        def services_ready():
+            for service, containers in self._inspect_services(ids).items():
+                if service in ready:
+                    continue
+                reason = self._service_not_ready(service, containers)
+                if reason is None:
+                    ready[service] = time.monotonic() - start
+                    waiting.pop(service, None)
+                else:
+                    waiting[service] = reason
+            return not waiting
+
+        try:
+            try:
+                wait_until(
+                    services_ready,
+                    max(deadline - time.monotonic(), 0),
+                    name="%s: services" % self.name,
+                )
+            except WaitTimeout:
+                pass
+            if "mender-api-gateway" in ready and not waiting:
+                from testutils.common import wait_for_traefik
+
+                wait_for_traefik(self.get_mender_gateway())
+                ready["mender-api-gateway"] = time.monotonic() - start
+        finally:
+            self._log_startup_report(ready, waiting)
+        if waiting:
+            raise Exception(
+                "timeout: services of docker-compose project %s not ready: %s"
+                % (self.name, ", ".join(sorted(waiting)))
+            )
+
+    def _inspect_services(self, ids):
+        """Returns {service: [(state, health, ip), ...]} of containers ids."""
+        services = {}
+        for container in get_docker_engine().inspect_many(ids):
+            service = container["Config"]["Labels"]["com.docker.compose.service"]
+            state = container["State"]
+            health = (state.get("Health") or {}).get("Status") or "-"
+            ip = self._mender_ip(container) or "-"
+            services.setdefault(service, []).append((state["Status"], health, ip))
+        return services
+
+    def _service_not_ready(self, service, containers):
+        """Returns why a service isn't ready yet, None if it is."""
+        for state, health, ip in containers:
+            if state != "running":
+                return state
+            if health not in ("-", "healthy"):
+                return health
+            path = self.HEALTH_ENDPOINTS.get(service)
+            if path is not None and ip != "-":
+                try:
+                    r = requests.get("http://%s:8080%s" % (ip, path), timeout=1)
+                except requests.exceptions.RequestException:
+                    return "health endpoint unreachable"
+                if r.status_code >= 300:
+                    return "health endpoint: %d" % r.status_code
+        return None
+
+    def _log_startup_report(self, ready, waiting):
+        lines = ["%s: service startup times:" % self.name]
+        for service, elapsed in sorted(ready.items(), key=lambda item: item[1]):
+            lines.append("  %-40s %6.1fs" % (service, elapsed))
+        for service, reason in sorted(waiting.items()):
+            lines.append("  %-40s not ready (%s)" % (service, reason))
+        logger.info("\n".join(lines))
+
+    def _containers(self, all=False, labels=[]):
+        """Returns the Docker Engine API summaries of the containers of this
+        namespace."""
+        labels = ["com.docker.compose.project=%s" % self.name] + labels
+        return get_docker_engine().containers(all=all, label=labels)
+
+    def _mender_ip(self, container):
+        """IP of a container (summary or inspect result) on the mender network."""
+        network = container["NetworkSettings"]["Networks"].get("%s_mender" % self.name)
+        return network and network["IPAddress"]
+
+    def _remove_containers(self, exclude=[]):
+        """Removes all containers (and their volumes) whose name contains
+        the namespace name, except those whose `docker ps` line matches one
+        of the 'exclude' regexes."""
+        engine = get_docker_engine()
+        for container in engine.containers(all=True, name=[self.name]):
+            if exclude and re.search("|".join(exclude), ps_line(container)):
+                continue
+            logger.info("removing container %s" % container["Names"][0].lstrip("/"))
+            engine.remove_container(container["Id"])
+
+    def _remove_networks(self):
+        engine = get_docker_engine()
+        for network in engine.networks(name=[self.name]):
+            logger.info("removing network %s" % network["Name"])
+            engine.remove_network(network["Id"])
 
     def _stop_docker_compose(self):
-        with docker_lock:
+        self.topology.close()
+        with self.lock:
             # Take down all docker instances in this namespace.
-            cmd = "docker ps -aq -f name=%s | xargs -r docker rm -fv" % self.name
-            logger.info("running %s" % cmd)
-            subprocess.check_call(cmd, shell=True)
-            cmd = (
-                "docker network list -q -f name=%s | xargs -r docker network rm"
-                % self.name
-            )
-            logger.info("running %s" % cmd)
-            subprocess.check_call(cmd, shell=True)
+            self._remove_containers()
+            self._remove_networks()
 
     _re_newlines_sub = re.compile(r"[\r\n]*").sub
 
@@ -196,53 +492,22 @@ class DockerComposeNamespace(DockerNamespace):
     def teardown_exclude(self, exclude=[]):
         """
         Take down all docker instances in this namespace, except for 'exclude'd container names.
-        'exclude' doesn't need exact names, it's a verbatim grep regex.
+        'exclude' doesn't need exact names, each entry is a regex matched against the
+        container's `docker ps` line.
         """
-        with docker_lock:
-            cmd = "docker ps -aq -f name=%s  | xargs -r docker rm -fv" % self.name
-
-            # exclude containers by crude grep -v and awk'ing out the id
-            # that's because docker -f allows only simple comparisons, no negations/logical ops
-            if len(exclude) != 0:
-                cmd_excl = 'grep -vE "(' + " | ".join(exclude) + ')"'
-                cmd_id = "awk 'NR>1 {print $1}'"
-                cmd = "docker ps -a -f name=%s | %s | %s | xargs -r docker rm -fv" % (
-                    self.name,
-                    cmd_excl,
-                    cmd_id,
-                )
-
-            logger.info("running %s" % cmd)
-            subprocess.check_call(cmd, shell=True)
+        self.topology.close()
+        with self.lock:
+            self._remove_containers(exclude)
 
             # if we're preserving some containers, don't destroy the network (will error out on exit)
             if len(exclude) == 0:
-                cmd = (
-                    "docker network list -q -f name=%s | xargs -r docker network rm"
-                    % self.name
-                )
-                logger.info("running %s" % cmd)
-                subprocess.check_call(cmd, shell=True)
+                self._remove_networks()
 
     def get_ip_of_service(self, service):
         """Return a list of IP addresseses of `service`. `service` is the same name as
         present in docker-compose files.
         """
-        temp = (
-            "docker ps -q "
-            "--filter label=com.docker.compose.project={project} "
-            "--filter label=com.docker.compose.service={service} "
-        )
-        cmd = temp.format(project=self.name, service=service)
-
-        output = subprocess.check_output(
-            cmd + "| xargs -r "
-            "docker inspect --format='{{.NetworkSettings.Networks.%s_mender.IPAddress}}'"
-            % self.name,
-            shell=True,
-        )
-
-        return output.decode().split()
+        return self.topology.ips(service)
 
     def get_logs_of_service(self, service):
         """Return logs of service"""
@@ -250,15 +515,11 @@ class DockerComposeNamespace(DockerNamespace):
 
     def get_virtual_network_host_ip(self):
         """Returns the IP of the host running the Docker containers"""
-        temp = "docker ps -q " "--filter label=com.docker.compose.project={project} "
-        cmd = temp.format(project=self.name)
-
-        output = subprocess.check_output(
-            cmd + "| head -n1 | xargs -r "
-            "docker inspect --format='{{range .NetworkSettings.Networks}}{{.Gateway}}{{end}}'",
-            shell=True,
+        container = self._containers()[0]
+        return "".join(
+            network["Gateway"]
+            for network in container["NetworkSettings"]["Networks"].values()
         )
-        return output.decode().split()[0]
 
     def get_mender_clients(self):
         """Returns IP address(es) of mender-client cotainer(s)"""
@@ -266,12 +527,14 @@ class DockerComposeNamespace(DockerNamespace):
         return clients
 
     def get_mender_client_by_container_name(self, image_name):
-        cmd = (
-            "docker inspect -f '{{range .NetworkSettings.Networks}}{{.IPAddress}}{{end}}' %s_%s"
-            % (self.name, image_name)
+        container = get_docker_engine().inspect("%s_%s" % (self.name, image_name))
+        return (
+            "".join(
+                network["IPAddress"]
+                for network in container["NetworkSettings"]["Networks"].values()
+            )
+            + ":8822"
         )
-        output = subprocess.check_output(cmd, shell=True)
-        return output.decode().strip() + ":8822"
 
     def get_mender_gateway(self):
         """Returns IP address of mender-api-gateway service"""
@@ -285,6 +548,94 @@ class DockerComposeNamespace(DockerNamespace):
 
         return gateway[0]
 
+    def reset(self):
+        """Brings a running namespace back to the state setup() left it in,
+        so that it can serve another test: removes the containers added
+        since (docker-compose run, e.g. new_tenant_client), empties the
+        database and migrates it as the services do at startup (restarting
+        the ones in AUTOMIGRATE_SERVICES), recreates the client containers
+        and waits until everything is ready again.
+
+        Raises if a backend service isn't running anymore, or if the
+        namespace runs more than one database (e.g. a second backend); the
+        namespace must then be torn down and set up anew.
+        """
+        from testutils.infra.cli import (
+            CliDeployments,
+            CliDeviceauth,
+            CliTenantadm,
+            CliUseradm,
+        )
+        from testutils.infra.mongo import MongoClient
+
+        containers = self._containers(all=True)
+        backend = set()
+        clients = {}
+        expected_containers = 0
+        for container in containers:
+            labels = container["Labels"]
+            service = labels["com.docker.compose.service"]
+            if labels.get("com.docker.compose.oneoff") == "True":
+                continue
+            expected_containers += 1
+            if service.startswith("mender-client"):
+                clients[service] = clients.get(service, 0) + 1
+                continue
+            if container["State"] != "running":
+                raise Exception(
+                    "%s: service %s is %s" % (self.name, service, container["State"])
+                )
+            backend.add(service)
+        mongos = sorted(s for s in backend if s.startswith("mender-mongo"))
+        if mongos != ["mender-mongo"]:
+            raise Exception(
+                "%s: cannot reset databases %s" % (self.name, ", ".join(mongos))
+            )
+
+        self.extra_files = copy.copy(self._setup_files)
+        engine = get_docker_engine()
+        for container in containers:
+            if container["Labels"].get("com.docker.compose.oneoff") == "True":
+                engine.remove_container(container["Id"])
+        self.topology.invalidate()
+
+        # stop the clients first, so that none of them talks to the backend
+        # between the cleanup and its recreation
+        services = " ".join(sorted(clients))
+        if clients:
+            self._docker_compose_cmd("rm -fsv %s" % services)
+
+        mongo = MongoClient("%s:27017" % self.get_ip_of_service("mender-mongo")[0])
+        try:
+            mongo.cleanup()
+        finally:
+            mongo.client.close()
+
+        # recreate the indexes and seed data the services set up at startup
+        if "mender-tenantadm" in backend:
+            CliTenantadm(container_manager=self).migrate()
+        CliUseradm(container_manager=self).migrate()
+        CliDeviceauth(container_manager=self).migrate()
+        CliDeployments(container_manager=self).migrate()
+        restart = sorted(backend.intersection(self.AUTOMIGRATE_SERVICES))
+        if restart:
+            self._docker_compose_cmd("restart %s" % " ".join(restart))
+
+        if clients:
+            scale = " ".join(
+                "--scale %s=%d" % (service, count)
+                for service, count in sorted(clients.items())
+            )
+            self._docker_compose_cmd("up -d --no-deps %s %s" % (scale, services))
+        self._wait_for_containers(expected_containers)
+
+    def cmd(self, container_id, docker_cmd, cmd=[]):
+        try:
+            return DockerNamespace.cmd(self, container_id, docker_cmd, cmd)
+        finally:
+            # e.g. "stop"/"start": don't wait for the events to tell
+            self.topology.invalidate()
+
     def restart_service(self, service):
         """Restarts a service."""
         self._docker_compose_cmd("scale %s=0" % service)
@@ -438,23 +789,10 @@ class DockerComposeCompatibilitySetup(DockerComposeNamespace):
                 self._docker_compose_cmd(compose_cmd.format(service=service))
 
     def get_mender_clients(self):
-        cmd = [
-            "docker",
-            "ps",
-            "--filter=label=com.docker.compose.project=" + self.name,
-            '--format={{.Label "com.docker.compose.service"}}',
-        ]
-
-        services = subprocess.check_output(cmd).decode().split()
-        clients = []
-        for service in services:
-            if service.startswith("mender-client"):
-                clients.append(service)
-
         addrs = []
-        for client in clients:
-            for ip in self.get_ip_of_service(client):
-                addrs.append(ip + ":8822")
+        for service, ips in self.topology.services().items():
+            if service.startswith("mender-client"):
+                addrs.extend(ip + ":8822" for ip in ips)
 
         return addrs
 
@@ -11,9 +11,11 @@
 #    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
+import re
 import subprocess
 
 from .base import BaseContainerManagerNamespace
+from .docker_api import get_docker_engine, ps_line
 
 
 class DockerNamespace(BaseContainerManagerNamespace):
@@ -39,13 +41,16 @@ class DockerNamespace(BaseContainerManagerNamespace):
         return ret.stdout.decode("utf-8").strip()
 
     def getid(self, filters):
+        """Returns the ids (newline separated) of the running containers of
+        this namespace whose `docker ps` line matches all filters."""
         filters.append(self.name)
-        filters = ["grep {}".format(f) for f in filters]
-        cmd = "docker ps | " + " | ".join(filters) + " | awk '{print $1}'"
+        ids = [
+            container["Id"][:12]
+            for container in get_docker_engine().containers()
+            if all(re.search(f, ps_line(container)) for f in filters)
+        ]
 
-        ret = subprocess.check_output(cmd, shell=True).decode("utf-8").strip()
-
-        if ret == "":
+        if not ids:
             raise RuntimeError("container id for {} not found".format(str(filters)))
 
-        return ret
+        return "\n".join(ids)
@@ -12,7 +12,10 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 import os
+import socket
 import subprocess
+import threading
+import time
 
 from .base import BaseContainerManagerNamespace
 
@@ -54,3 +57,89 @@ class KubernetesNamespace(BaseContainerManagerNamespace):
 
 def isK8S() -> bool:
     return bool(os.environ.get("K8S"))
+
+
+class PortForward:
+    """A `kubectl port-forward` tunnel from a free local port to a service."""
+
+    def __init__(self, service, port, timeout=30.0):
+        self.service = service
+        self.port = port
+        self.local_port = _free_local_port()
+        cmd = [
+            "kubectl",
+            "port-forward",
+            "service/" + service,
+            "%d:%s" % (self.local_port, port),
+        ]
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+        try:
+            self._wait_ready(timeout)
+        except:
+            self.close()
+            raise
+
+    def _wait_ready(self, timeout):
+        """Probe the local port until kubectl accepts connections on it."""
+        deadline = time.monotonic() + timeout
+        delay = 0.01
+        while True:
+            if self.proc.poll() is not None:
+                raise RuntimeError(
+                    "kubectl port-forward to service/%s exited with code %d"
+                    % (self.service, self.proc.returncode)
+                )
+            try:
+                with socket.create_connection(("localhost", self.local_port), 1):
+                    return
+            except OSError:
+                pass
+            if time.monotonic() >= deadline:
+                raise TimeoutError(
+                    "kubectl port-forward to service/%s not ready after %.1fs"
+                    % (self.service, timeout)
+                )
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def close(self):
+        if self.alive():
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+
+
+def _free_local_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+_port_forwards = {}
+_port_forwards_lock = threading.Lock()
+
+
+def get_port_forward(service, port):
+    """Returns a running PortForward to service:port, reusing the tunnel
+    started by a previous call if it is still alive."""
+    key = (service, str(port))
+    with _port_forwards_lock:
+        fwd = _port_forwards.get(key)
+        if fwd is None or not fwd.alive():
+            fwd = PortForward(service, port)
+            _port_forwards[key] = fwd
+        return fwd
+
+
+def close_port_forwards():
+    """Tears down all the port forwards started by this process."""
+    with _port_forwards_lock:
+        fwds = list(_port_forwards.values())
+        _port_forwards.clear()
+    for fwd in fwds:
+        fwd.close()
@@ -0,0 +1,130 @@
+# Copyright 2020 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Pool of running namespaces, so that function scoped fixtures reuse a
+# namespace set up for an earlier test instead of starting a new one: a
+# namespace is leased, reset (see BaseContainerManagerNamespace.reset) and
+# returned when the test is done. Namespaces of failed tests, and the ones
+# which fail to reset, are torn down instead. The pool lives in the process,
+# i.e. each xdist worker keeps its own idle namespaces.
+
+import logging
+import os
+import threading
+
+logger = logging.getLogger()
+
+# Idle namespaces each process (xdist worker) keeps, the least recently used
+# are torn down beyond it. 0 disables the pool.
+ENV_POOL_SIZE = int(os.environ.get("INTEGRATION_ENV_POOL_SIZE") or 1)
+
+
+class EnvironmentPool:
+    def __init__(self, size=ENV_POOL_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.recycled = 0
+        # [(setup type, namespace)], least recently returned first
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def lease(self, key, create):
+        """
+        Returns a running namespace of setup type key: an idle one, reset,
+        or else create() set up.
+        """
+        while True:
+            env = self._take(key)
+            if env is None:
+                break
+            try:
+                env.reset()
+            except Exception as e:
+                logger.info("%s: reset failed, recycling it: %s" % (env.name, e))
+                self._teardown(env, recycled=True)
+                continue
+            logger.info("%s: reusing environment %s" % (key, env.name))
+            with self._lock:
+                self.hits += 1
+            return env
+
+        with self._lock:
+            self.misses += 1
+        env = create()
+        try:
+            env.setup()
+        except Exception:
+            env.teardown()
+            raise
+        return env
+
+    def release(self, key, env, failed=False):
+        """
+        Returns a leased namespace; it is torn down if the test failed (its
+        state is unknown, and its logs are wanted) or the pool is full.
+        """
+        if failed or self.size <= 0:
+            self._teardown(env, recycled=failed)
+            return
+        with self._lock:
+            self._idle.append((key, env))
+            evicted = self._idle[: max(len(self._idle) - self.size, 0)]
+            del self._idle[: len(evicted)]
+        for _, env in evicted:
+            self._teardown(env)
+
+    def close(self):
+        """Tears down all idle namespaces."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for _, env in idle:
+            self._teardown(env)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "recycled": self.recycled,
+            }
+
+    def _take(self, key):
+        with self._lock:
+            for i in reversed(range(len(self._idle))):
+                if self._idle[i][0] == key:
+                    return self._idle.pop(i)[1]
+        return None
+
+    def _teardown(self, env, recycled=False):
+        if recycled:
+            with self._lock:
+                self.recycled += 1
+        try:
+            env.teardown()
+        except Exception as e:
+            logger.error("%s: teardown failed: %s" % (env.name, e))
+
+
+_environment_pool = None
+_environment_pool_lock = threading.Lock()
+
+
+def get_environment_pool():
+    """Returns the process wide EnvironmentPool."""
+    global _environment_pool
+    with _environment_pool_lock:
+        if _environment_pool is None:
+            _environment_pool = EnvironmentPool()
+        return _environment_pool
@@ -1,9 +1,37 @@
+import errno
+import gzip
 import io
+import lzma
+import mmap
 import os
 import random
+import re
+import shutil
+import socket
+import stat
+import subprocess
 import tarfile
+import tempfile
 import hashlib
 import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from testutils.util.crypto import artifact_sign, artifact_verify
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Whether payload files are read sparse-aware by default: holes (found with
+# SEEK_DATA/SEEK_HOLE) are produced as zeros without reading them, and all
+# zero blocks are compressed once per payload.
+SPARSE = os.environ.get("ARTIFACT_SPARSE", "1") != "0"
+
+# Payload type of binary delta updates, applied by the mender-binary-delta
+# update module on the device.
+DELTA_PAYLOAD_TYPE = "mender-binary-delta"
 
 # Valid state-script states
 _valid_states = (
@@ -24,6 +52,315 @@ _valid_states = (
     "ArtifactFailure_Leave",
 )
 
+# State script names: <state>[_<NN>[_<description>]], e.g.
+# ArtifactInstall_Enter_05_wifi-driver
+_script_name = re.compile(r"^([A-Za-z]+_(?:Enter|Leave|Error))(_[0-9]{2}(_.*)?)?$")
+
+
+class _NoCompression:
+    name = "none"
+    suffix = ""
+    default_level = None
+    available = True
+
+    def compress(self, data, level):
+        return data
+
+    def writer(self, fileobj, level):
+        return _PassthroughWriter(fileobj)
+
+    def reader(self, fileobj):
+        return fileobj
+
+
+class _GzipCompression:
+    name = "gzip"
+    suffix = ".gz"
+    default_level = 9
+    available = True
+
+    # No timestamp in the gzip header (unlike tarfile's "w:gz"), so that the
+    # same content always compresses to the same bytes.
+    def compress(self, data, level):
+        return gzip.compress(data, level, mtime=0)
+
+    def writer(self, fileobj, level):
+        return gzip.GzipFile(
+            filename="", mode="wb", fileobj=fileobj, compresslevel=level, mtime=0
+        )
+
+    def reader(self, fileobj):
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+
+
+class _XzCompression:
+    name = "xz"
+    suffix = ".xz"
+    default_level = 6
+    available = True
+
+    def compress(self, data, level):
+        return lzma.compress(data, preset=level)
+
+    def writer(self, fileobj, level):
+        return lzma.LZMAFile(fileobj, "wb", preset=level)
+
+    def reader(self, fileobj):
+        return lzma.LZMAFile(fileobj, "rb")
+
+
+class _ZstdCompression:
+    name = "zstd"
+    suffix = ".zst"
+    default_level = 3
+    available = zstandard is not None
+
+    def _check(self):
+        if zstandard is None:
+            raise RuntimeError("zstd compression requires the zstandard package")
+
+    def compress(self, data, level):
+        self._check()
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+    def writer(self, fileobj, level):
+        self._check()
+        return zstandard.ZstdCompressor(level=level).stream_writer(
+            fileobj, closefd=False, write_return_read=True
+        )
+
+    def reader(self, fileobj):
+        self._check()
+        return zstandard.ZstdDecompressor().stream_reader(
+            fileobj, read_across_frames=True, closefd=False
+        )
+
+
+# Payload and header compressions supported by the artifact format, by the
+# name mender-artifact's --compression flag uses.
+COMPRESSIONS = {
+    c.name: c
+    for c in (
+        _NoCompression(),
+        _GzipCompression(),
+        _XzCompression(),
+        _ZstdCompression(),
+    )
+}
+
+
+def _open_tar(fileobj, compression, level, executor=None, sparse=False):
+    """
+    Opens a compressed tar for writing into fileobj, returns the tar and
+    compressor file objects, which both need closing.
+    If executor is given, the tar is compressed in parallel blocks on it,
+    compressing zero blocks only once if sparse.
+    """
+    if executor is not None and compression.name != "none":
+        compressor = _ParallelWriter(
+            fileobj,
+            executor,
+            lambda block: compression.compress(block, level),
+            reuse_zero_blocks=sparse,
+        )
+    else:
+        compressor = compression.writer(fileobj, level)
+    return tarfile.open(fileobj=compressor, mode="w"), compressor
+
+
+class _PassthroughWriter:
+    """
+    Write-only file object writing straight into fileobj, without closing it.
+    """
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._size = 0
+
+    def write(self, data):
+        self._fileobj.write(data)
+        self._size += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._size
+
+    def close(self):
+        pass
+
+
+class _ParallelWriter:
+    """
+    Write-only file object compressing pigz-style: the input is cut into
+    blocks which are compressed concurrently on executor (zlib, lzma and
+    zstd release the GIL) and written out in order as concatenated
+    gzip members / xz streams / zstd frames, which is still a valid
+    compressed stream. At most max_pending blocks are in flight.
+    With reuse_zero_blocks, all zero blocks are compressed only once.
+    """
+
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(
+        self,
+        fileobj,
+        executor,
+        compress,
+        block_size=BLOCK_SIZE,
+        max_pending=8,
+        reuse_zero_blocks=False,
+    ):
+        self._fileobj = fileobj
+        self._executor = executor
+        self._compress = compress
+        self._block_size = block_size
+        self._max_pending = max_pending
+        self._buf = bytearray()
+        self._pending = deque()
+        self._size = 0
+        self._members = 0
+        self._zero_block = bytes(block_size) if reuse_zero_blocks else None
+        self._zero_future = None
+        self.zero_blocks = 0
+
+    def write(self, data):
+        self._buf += data
+        self._size += len(data)
+        while len(self._buf) >= self._block_size:
+            self._submit(bytes(self._buf[: self._block_size]))
+            del self._buf[: self._block_size]
+        return len(data)
+
+    def tell(self):
+        return self._size
+
+    def _submit(self, block):
+        if len(self._pending) >= self._max_pending:
+            self._fileobj.write(self._pending.popleft().result())
+        if self._zero_block is not None and block == self._zero_block:
+            # the compressed members are deterministic, so all zero blocks
+            # (e.g. the unused space of a filesystem image) compress alike
+            if self._zero_future is None:
+                self._zero_future = self._executor.submit(self._compress, block)
+            self._pending.append(self._zero_future)
+            self.zero_blocks += 1
+        else:
+            self._pending.append(self._executor.submit(self._compress, block))
+        self._members += 1
+
+    def close(self):
+        if self._buf or self._members == 0:
+            self._submit(bytes(self._buf))
+            self._buf = bytearray()
+        while self._pending:
+            self._fileobj.write(self._pending.popleft().result())
+
+
+class _SparseReader:
+    """
+    Read-only file object over a regular file which produces its holes as
+    zeros without reading them, finding the data extents with SEEK_DATA
+    and SEEK_HOLE. Counts the bytes read from holes in hole_bytes.
+    It reads with pread from its own position, leaving fd's offset
+    undefined: seek fd before using it again.
+    """
+
+    def __init__(self, fd):
+        self._fd = fd
+        self._fileno = fd.fileno()
+        self._size = os.fstat(self._fileno).st_size
+        self._pos = fd.tell()
+        # [self._pos, self._extent_end) is data if self._in_data else a hole
+        self._extent_end = self._pos
+        self._in_data = True
+        self.hole_bytes = 0
+
+    @staticmethod
+    def supported(fd):
+        """
+        Whether fd is a regular file whose filesystem reports holes.
+        """
+        if not hasattr(os, "SEEK_DATA"):
+            return False
+        try:
+            fileno = fd.fileno()
+            if not stat.S_ISREG(os.fstat(fileno).st_mode):
+                return False
+            # lseek moves the file offset, which fd may be using
+            pos = os.lseek(fileno, 0, os.SEEK_CUR)
+            os.lseek(fileno, 0, os.SEEK_HOLE)
+            os.lseek(fileno, pos, os.SEEK_SET)
+        except (AttributeError, OSError):
+            return False
+        return True
+
+    def fileno(self):
+        return self._fileno
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._pos = offset
+        self._extent_end = offset
+        return offset
+
+    def _next_extent(self):
+        try:
+            data = os.lseek(self._fileno, self._pos, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+            # no more data, the rest of the file is a hole
+            data = self._size
+        if data > self._pos:
+            self._in_data = False
+            self._extent_end = data
+        else:
+            self._in_data = True
+            self._extent_end = os.lseek(self._fileno, self._pos, os.SEEK_HOLE)
+
+    def read(self, size=-1):
+        # reads are never short but at the end of the file, as tarfile
+        # expects
+        if size is None or size < 0:
+            size = self._size - self._pos
+        bufs = []
+        while size > 0 and self._pos < self._size:
+            if self._pos >= self._extent_end:
+                self._next_extent()
+            n = min(self._extent_end - self._pos, size)
+            if self._in_data:
+                buf = os.pread(self._fileno, n, self._pos)
+                if not buf:
+                    break
+            else:
+                buf = bytes(n)
+                self.hole_bytes += n
+            bufs.append(buf)
+            self._pos += len(buf)
+            size -= len(buf)
+        return bufs[0] if len(bufs) == 1 else b"".join(bufs)
+
+
+class _HashingReader:
+    """
+    File object wrapper feeding everything read through it into a hash.
+    """
+
+    def __init__(self, fd, hash):
+        self._fd = fd
+        self._hash = hash
+
+    def read(self, size=-1):
+        buf = self._fd.read(size)
+        self._hash.update(buf)
+        return buf
+
 
 class Artifact:
     """
@@ -32,7 +369,8 @@ class Artifact:
     resides in memory.
     """
 
-    _dummySHA = "%064d" % 0
+    # compressed payloads larger than this are spooled to disk when streaming
+    SPOOL_SIZE = 16 * 1024 * 1024
 
     def __init__(
         self,
@@ -43,12 +381,39 @@ class Artifact:
         payload_type="rootfs-image",
         provides=None,
         depends=None,
+        compression_workers=None,
+        compression="gzip",
+        compression_level=None,
+        artifact_depends=None,
+        private_key=None,
+        cache=None,
+        sparse=SPARSE,
     ):
         """
         :param artifact_name: name of the artifact (str)
         :param device_types:  list of compatible device types (list)
+        :param artifact_group: optional group the artifact provides (str)
         :param payload:       optional payload to initialize the payload
                               section (file, io.IOBase, str, bytes)
+        :param compression_workers: number of threads compressing payloads
+                              (int), defaults to the number of CPUs; 1
+                              compresses each payload as a single stream
+        :param compression: compression of the header and payloads, one of
+                              COMPRESSIONS: "none", "gzip", "xz", "zstd"
+        :param compression_level: level of the compression (int), defaults
+                              to gzip 9, xz 6, zstd 3
+        :param artifact_depends: optional artifact level depends besides
+                              the device types (dict), i.e. the artifact_name
+                              and artifact_group lists installed artifacts
+                              must match
+        :param private_key:   optional PEM private key (str, bytes) signing
+                              the manifest (RSA, ECDSA or ed25519)
+        :param cache:         optional ArtifactCache (see
+                              testutils.util.artifact_cache) to reuse the
+                              compressed payloads from
+        :param sparse:        read payload files sparse-aware: skip reading
+                              holes and compress zero blocks once, defaults
+                              to ARTIFACT_SPARSE (on)
         """
         if not isinstance(artifact_name, str):
             raise TypeError("artifact_name must be type str")
@@ -56,14 +421,36 @@ class Artifact:
             raise TypeError("device_types must be a list of strings")
         elif len(device_types) == 0:
             raise ValueError("device_types cannot be empty")
+        if compression not in COMPRESSIONS:
+            raise ValueError(
+                "compression must be one of: %s" % ", ".join(COMPRESSIONS.keys())
+            )
 
-        self._filenames = ["version", "header.tar.gz"]
+        self._compression = COMPRESSIONS[compression]
+        self._compression_level = (
+            compression_level
+            if compression_level is not None
+            else self._compression.default_level
+        )
+        self._header_name = "header.tar" + self._compression.suffix
+        self._filenames = ["version", self._header_name]
         self._payloads = {}
         self._provides = {"header-info": {"artifact_name": artifact_name}}
         self._provide_keys = ["artifact_name"]
         self._depends = {"header-info": {"device_type": device_types}}
         self._depend_keys = ["device_type"]
         self._state_scripts = []
+        self._clears_provides = {}
+        self._checksum_provides = {}
+        self._private_key = private_key
+        self._cache = cache
+        self._sparse = sparse
+        self._hole_bytes = {}
+
+        if isinstance(artifact_depends, dict):
+            self._depends["header-info"].update(artifact_depends)
+        elif artifact_depends is not None:
+            raise TypeError("artifact_depends must be a dict or None.")
 
         if artifact_group is not None:
             self._provides["header-info"]["artifact_group"] = artifact_group
@@ -71,13 +458,24 @@ class Artifact:
 
         self._payload_types = {}
         self._shasums = {}
+        self._compression_workers = compression_workers or os.cpu_count() or 1
 
         if payload is not None:
             self.add_payload(payload, payload_type, depends, provides)
 
     def add_state_script(self, state, script):
-        if state not in _valid_states:
-            raise ValueError("%s is not a valid state, check artifact specifications")
+        """
+        add_state_script adds a state script to the header.
+        :param state:  state the script runs in, optionally with the
+                       ordering number and a description as mender-artifact
+                       expects, e.g. ArtifactInstall_Enter_00_migrate (str)
+        :param script: the script (str, bytes, io.IOBase)
+        """
+        match = _script_name.match(state)
+        if match is None or match.group(1) not in _valid_states:
+            raise ValueError(
+                "%s is not a valid state, check artifact specifications" % state
+            )
 
         if isinstance(script, str):
             script = io.BytesIO(script.encode())
@@ -89,7 +487,16 @@ class Artifact:
             )
         self._state_scripts.append((state, script))
 
-    def add_payload(self, fd, payload_type="rootfs-image", depends=None, provides=None):
+    def add_payload(
+        self,
+        fd,
+        payload_type="rootfs-image",
+        depends=None,
+        provides=None,
+        clears_provides=None,
+        checksum_provide=None,
+        name=None,
+    ):
         """
         add_payload adds another payload to the payload section.
         NOTE: provides- and depends-keys must be unique across payloads.
@@ -98,6 +505,13 @@ class Artifact:
         :param payload_type: type of payload contained in fd (str)
         :param depends:      optional depends for this payload (dict)
         :param provides:     optional provides for this payload (dict)
+        :param clears_provides: optional provides (wildcards allowed) this
+                             payload clears on the device when installed
+                             (list)
+        :param checksum_provide: optional provides key set to the payload's
+                             sha256 checksum, e.g. rootfs-image.checksum (str)
+        :param name:         file name of the payload, defaults to the name
+                             of fd (str)
         """
         if isinstance(fd, str):
             fd = io.BytesIO(fd.encode())
@@ -105,17 +519,16 @@ class Artifact:
             fd = io.BytesIO(fd)
         elif not isinstance(fd, io.IOBase):
             raise TypeError("fd must be an instance of either io.FileIO, str or bytes.")
-        filename = "data/%04d/%s" % (
-            len(self._payloads),
-            getattr(fd, "name", "rootfs-%04d.ext4" % random.randint(0, 10000)),
-        )
+        if name is None:
+            name = getattr(fd, "name", "rootfs-%04d.ext4" % random.randint(0, 10000))
+        filename = "data/%04d/%s" % (len(self._payloads), os.path.basename(name))
 
         if isinstance(depends, dict):
             for key in depends:
                 if key in self._depend_keys:
                     raise ValueError("Depends key %s already present." % key)
             self._depends[filename] = depends
-            self._depend_keys.append(*list(depends.keys()))
+            self._depend_keys.extend(depends.keys())
         elif depends is not None:
             raise TypeError("Depends must be a dict or None.")
 
@@ -123,11 +536,19 @@ class Artifact:
             for key in provides:
                 if key in self._provide_keys:
                     raise ValueError("Provides key %s already present." % key)
-            self._provide_keys.append(*list(provides.keys()))
+            self._provide_keys.extend(provides.keys())
             self._provides[filename] = provides
         elif provides is not None:
             raise TypeError("provides must be a dict or None.")
 
+        if clears_provides is not None:
+            self._clears_provides[filename] = list(clears_provides)
+        if checksum_provide is not None:
+            if checksum_provide in self._provide_keys:
+                raise ValueError("Provides key %s already present." % checksum_provide)
+            self._provide_keys.append(checksum_provide)
+            self._checksum_provides[filename] = checksum_provide
+
         self._filenames.append(filename)
         self._payloads[filename] = fd
         self._payload_types[filename] = payload_type
@@ -139,15 +560,169 @@ class Artifact:
         :returns: artifact (io.BytesIO)
         """
         self._artifact = io.BytesIO()
-        self._tarfact = tarfile.open(fileobj=self._artifact, mode="w")
-        self._add_version()
-        self._initialize_manifest()
-        self._add_header()
-        self._add_payloads()
-        self._complete_manifest()
+        self.write(self._artifact)
         self._artifact.seek(0)
         return self._artifact
 
+    def write(self, dest, spool_size=SPOOL_SIZE):
+        """
+        write streams the artifact at the current state into dest, with
+        bounded memory use regardless of the payload sizes: compressed
+        payloads are spooled to a temporary file (above spool_size bytes)
+        until the manifest is written, then copied chunk by chunk.
+        dest may also be a pipe or a socket since it is never seeked.
+        :param dest: a path (str), a socket or a writable file object
+        """
+        if isinstance(dest, (str, os.PathLike)):
+            with open(dest, "wb") as f:
+                return self.write(f, spool_size)
+        if isinstance(dest, socket.socket):
+            with dest.makefile("wb") as f:
+                return self.write(f, spool_size)
+
+        spools = {}
+        workers = self._compression_workers
+        block_pool = ThreadPoolExecutor(workers) if workers > 1 else None
+        payload_pool = ThreadPoolExecutor(workers)
+        try:
+            # Compress the payloads concurrently, sharing the block pool.
+            futures = {
+                filename: payload_pool.submit(
+                    self._payload_section, filename, spool_size, block_pool
+                )
+                for filename in sorted(self._payloads.keys())
+            }
+            for filename, future in futures.items():
+                spools[filename] = future.result()
+
+            hdr_tarbin = self._make_header()
+            self._tarfact = tarfile.open(fileobj=dest, mode="w|")
+            self._add_version()
+            self._add_manifest()
+            self._add_header(hdr_tarbin)
+            for filename in sorted(spools.keys()):
+                spool = spools[filename]
+                tarhdr = tarfile.TarInfo(
+                    os.path.dirname(filename) + ".tar" + self._compression.suffix
+                )
+                tarhdr.size = spool.tell()
+                spool.seek(0)
+                self._tarfact.addfile(tarhdr, spool)
+            self._tarfact.close()
+        finally:
+            payload_pool.shutdown()
+            if block_pool is not None:
+                block_pool.shutdown()
+            for spool in spools.values():
+                spool.close()
+
+    def _payload_section(self, filename, spool_size, executor=None):
+        """
+        Returns the compressed payload section, positioned at its end: from
+        the cache if there is one, else freshly compressed.
+        """
+        if self._cache is None:
+            return self._spool_payload(filename, spool_size, executor)
+
+        fd = self._payloads[filename]
+        sha = self._cache.known_digest(fd)
+        if sha is None:
+            # first build of this payload: its checksum (the cache key) is
+            # computed while compressing it, so it is still read only once
+            spool = self._spool_payload(filename, spool_size, executor)
+            sha = self._shasums[filename]
+            self._cache.remember(fd, sha)
+            key = self._cache_key(sha, filename)
+            with self._cache.building(key):
+                self._cache.put(key, spool, sha)
+            spool.seek(0, io.SEEK_END)
+            return spool
+
+        key = self._cache_key(sha, filename)
+        with self._cache.building(key):
+            cached = self._cache.get(key)
+            if cached is None:
+                spool = self._spool_payload(filename, spool_size, executor)
+                self._cache.put(key, spool, self._shasums[filename])
+                spool.seek(0, io.SEEK_END)
+                return spool
+        section, self._shasums[filename] = cached
+        section.seek(0, io.SEEK_END)
+        return section
+
+    def _cache_key(self, sha, filename):
+        return self._cache.key(
+            sha,
+            os.path.basename(filename),
+            self._compression.name,
+            self._compression_level,
+        )
+
+    def _spool_payload(self, filename, spool_size, executor=None):
+        """
+        Compresses a payload into a temporary spool (in parallel blocks on
+        executor, if given) and computes its checksum in the same pass,
+        returns the spool positioned at its end.
+        """
+        fd = self._payloads[filename]
+        size = fd.seek(0, io.SEEK_END)
+        fd.seek(0)
+        reader = self._reader(fd)
+
+        # Hash the payload on its way into the compressor, so that it is
+        # read only once.
+        sha = hashlib.sha256()
+        spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        payload_tar, compressor = _open_tar(
+            spool,
+            self._compression,
+            self._compression_level,
+            executor,
+            sparse=self._sparse,
+        )
+        tarhdr = tarfile.TarInfo(os.path.basename(filename))
+        tarhdr.size = size
+        # read the payload in compression block sized chunks
+        payload_tar.copybufsize = _ParallelWriter.BLOCK_SIZE
+        payload_tar.addfile(tarhdr, _HashingReader(reader, sha))
+        payload_tar.close()
+        compressor.close()
+        self._shasums[filename] = sha.hexdigest()
+        self._hole_bytes[filename] = getattr(reader, "hole_bytes", 0)
+        return spool
+
+    def _reader(self, fd):
+        if self._sparse and _SparseReader.supported(fd):
+            return _SparseReader(fd)
+        return fd
+
+    @property
+    def hole_bytes(self):
+        """
+        Number of payload bytes the last write produced from file holes
+        instead of reading them.
+        """
+        return sum(self._hole_bytes.values())
+
+    def _add_manifest(self):
+        """
+        Adds the manifest of the already computed checksums, and its
+        signature if the artifact is signed.
+        """
+        manifest = b"".join(
+            ("%s  %s\n" % (self._shasums[filename], filename)).encode()
+            for filename in self._filenames[::-1]
+        )
+        tarhdr = tarfile.TarInfo("manifest")
+        tarhdr.size = len(manifest)
+        self._tarfact.addfile(tarhdr, fileobj=io.BytesIO(manifest))
+
+        if self._private_key is not None:
+            signature = artifact_sign(manifest, self._private_key).encode()
+            tarhdr = tarfile.TarInfo("manifest.sig")
+            tarhdr.size = len(signature)
+            self._tarfact.addfile(tarhdr, fileobj=io.BytesIO(signature))
+
     def _compute_checksum(self, filename, fd):
         fd.seek(0)
         BUFSIZE = 1024 * 1024
@@ -164,59 +739,6 @@ class Artifact:
         fd.seek(0)
         return size
 
-    def _initialize_manifest(self):
-        """
-        This is sort of cheating: this function initialize the manifest
-        bogus checksums. Later, _complete_manifest will seek to the stored
-        checksum offsets and overwrite these checksums with the correct
-        one.
-        """
-        tmp_manifest = io.BytesIO()
-        self._manifest_offsets = {}
-        for filename in self._filenames[::-1]:
-            self._manifest_offsets[filename] = tmp_manifest.tell()
-            tmp_manifest.write(("%s  %s\n" % (self._dummySHA, filename)).encode())
-        size = tmp_manifest.tell()
-        tarhdr = tarfile.TarInfo("manifest")
-        tarhdr.size = size
-        tmp_manifest.seek(0)
-        self._tarfact.addfile(tarhdr, fileobj=tmp_manifest)
-
-    def _complete_manifest(self):
-        self._artifact.seek(0)
-        rdtar = tarfile.open(fileobj=self._artifact, mode="r")
-        manifest_hdr = rdtar.getmember("manifest")
-        offset = manifest_hdr.offset_data
-        for filename in self._filenames[::-1]:
-            offset_sha = offset + self._manifest_offsets[filename]
-            self._artifact.seek(offset_sha)
-            self._artifact.write(self._shasums[filename].encode())
-
-    def _add_payloads(self):
-        """
-        Adds all the stored payload to artifact.
-        Each payload is itself a compressed tar.
-        """
-        filenames = sorted(list(self._payloads.keys()))
-        for filename in filenames:
-            fd = self._payloads[filename]
-
-            size = fd.seek(0, io.SEEK_END)
-            fd.seek(0)
-
-            payload_tarbin = io.BytesIO()
-            payload_tar = tarfile.open(fileobj=payload_tarbin, mode="w:gz")
-            tarhdr = tarfile.TarInfo(os.path.basename(filename))
-            tarhdr.size = size
-            payload_tar.addfile(tarhdr, fd)
-            payload_tar.close()
-
-            tarhdr = tarfile.TarInfo(os.path.dirname(filename) + ".tar.gz")
-            tarhdr.size = payload_tarbin.tell()
-            self._compute_checksum(filename, fd)
-            payload_tarbin.seek(0)
-            self._tarfact.addfile(tarhdr, payload_tarbin)
-
     def _add_version(self):
         version = {"format": "mender", "version": 3}
         fd = io.BytesIO(json.dumps(version).encode())
@@ -225,15 +747,27 @@ class Artifact:
         tarhdr.size = size
         self._tarfact.addfile(tarhdr, fd)
 
-    def _add_header(self):
+    def _add_header(self, hdr_tarbin=None):
+        if hdr_tarbin is None:
+            hdr_tarbin = self._make_header()
+        size = hdr_tarbin.seek(0, io.SEEK_END)
+        hdr_tarbin.seek(0)
+        tarhdr = tarfile.TarInfo(self._header_name)
+        tarhdr.size = size
+        self._tarfact.addfile(tarhdr, hdr_tarbin)
+
+    def _make_header(self):
+        """
+        Builds the (compressed) header tar and computes its checksum.
+        """
         hdr_tarbin = io.BytesIO()
-        hdr_tar = tarfile.open(fileobj=hdr_tarbin, mode="w:gz")
+        hdr_tar, compressor = _open_tar(
+            hdr_tarbin, self._compression, self._compression_level
+        )
         header_info = {
             "payloads": [
-                {
-                    "type": self._payload_types[filename]
-                    for filename in sorted(self._payloads.keys())
-                }
+                {"type": self._payload_types[filename]}
+                for filename in sorted(self._payloads.keys())
             ]
         }
         header_info["artifact_provides"] = self._provides["header-info"]
@@ -259,7 +793,13 @@ class Artifact:
             if filename in self._depends:
                 typeinfo["artifact_depends"] = self._depends[filename]
             if filename in self._provides:
-                typeinfo["artifact_provides"] = self._provides[filename]
+                typeinfo["artifact_provides"] = dict(self._provides[filename])
+            if filename in self._checksum_provides:
+                typeinfo.setdefault("artifact_provides", {})[
+                    self._checksum_provides[filename]
+                ] = self._shasums[filename]
+            if filename in self._clears_provides:
+                typeinfo["clears_artifact_provides"] = self._clears_provides[filename]
 
             # Add type-info to tarfile
             typeinfo_bin = io.BytesIO(json.dumps(typeinfo).encode())
@@ -275,10 +815,9 @@ class Artifact:
 
         # Complete tar padding
         hdr_tar.close()
-        size = self._compute_checksum("header.tar.gz", hdr_tarbin)
-        tarhdr = tarfile.TarInfo("header.tar.gz")
-        tarhdr.size = size
-        self._tarfact.addfile(tarhdr, hdr_tarbin)
+        compressor.close()
+        self._compute_checksum(self._header_name, hdr_tarbin)
+        return hdr_tarbin
 
     def __del__(self):
         """
@@ -290,3 +829,515 @@ class Artifact:
                 del self._payloads[filename]
             except Exception:
                 pass
+
+
+class _Section(io.RawIOBase):
+    """
+    Read-only file object over a region of a mmap.
+    """
+
+    def __init__(self, mm, offset, size):
+        self._mmap = mm
+        self._pos = offset
+        self._end = offset + size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), self._end - self._pos)
+        b[:n] = self._mmap[self._pos : self._pos + n]
+        self._pos += n
+        return n
+
+
+class MenderArtifactReader:
+    """
+    MenderArtifactReader reads a mender artifact (format version 3) mapped
+    into memory: listing the artifact only reads the tar headers, and the
+    header is decompressed on first use, so inspecting an artifact costs
+    time proportional to its header, not its payloads. Payloads are only
+    decompressed when streamed with open_payload.
+
+        with MenderArtifactReader("rootfs.mender") as reader:
+            assert reader.artifact_provides["artifact_name"] == "rel-1"
+            assert reader.verify(public_key)
+    """
+
+    def __init__(self, artifact):
+        """
+        :param artifact: path (str) or file object of the artifact,
+                         which must have a fileno (e.g. not io.BytesIO)
+        """
+        if isinstance(artifact, (str, os.PathLike)):
+            self._file = open(artifact, "rb")
+        else:
+            self._file = None
+        fd = (self._file or artifact).fileno()
+        self._mmap = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        self._entries = {}
+        with tarfile.open(fileobj=self._mmap, mode="r:") as tar:
+            for member in tar:
+                self._entries[member.name] = (member.offset_data, member.size)
+        self._header = None
+
+        header_names = [n for n in self._entries if n.startswith("header.tar")]
+        if len(header_names) != 1:
+            raise ValueError("not a mender artifact: no header")
+        self.header_name = header_names[0]
+        suffix = self.header_name[len("header.tar") :]
+        codecs = [c for c in COMPRESSIONS.values() if c.suffix == suffix]
+        if not codecs:
+            raise ValueError("unsupported header compression: %s" % self.header_name)
+        self.compression = codecs[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._mmap.close()
+        if self._file is not None:
+            self._file.close()
+
+    def names(self):
+        """
+        Returns the names of the entries of the outer tar, in order.
+        """
+        return list(self._entries.keys())
+
+    def read(self, name):
+        """
+        Returns the raw (compressed) contents of an entry (bytes).
+        """
+        offset, size = self._entries[name]
+        return self._mmap[offset : offset + size]
+
+    def size(self, name):
+        """
+        Returns the size of the raw (compressed) contents of an entry.
+        """
+        return self._entries[name][1]
+
+    def open(self, name):
+        """
+        Returns a file object streaming the raw contents of an entry.
+        """
+        offset, size = self._entries[name]
+        return io.BufferedReader(_Section(self._mmap, offset, size))
+
+    @property
+    def version(self):
+        return json.loads(self.read("version"))
+
+    @property
+    def manifest(self):
+        """
+        The manifest as a dict, {filename: sha256 hexdigest}.
+        """
+        manifest = {}
+        for line in self.read("manifest").decode().splitlines():
+            if line:
+                sha, filename = line.split(None, 1)
+                manifest[filename] = sha
+        return manifest
+
+    @property
+    def signature(self):
+        """
+        The manifest signature (base64, bytes), None if not signed.
+        """
+        if "manifest.sig" not in self._entries:
+            return None
+        return self.read("manifest.sig")
+
+    def _load_header(self):
+        if self._header is None:
+            header = {}
+            reader = self.compression.reader(self.open(self.header_name))
+            with tarfile.open(fileobj=reader, mode="r|") as tar:
+                for member in tar:
+                    if member.isfile():
+                        header[member.name] = tar.extractfile(member).read()
+            self._header = header
+        return self._header
+
+    @property
+    def header_info(self):
+        return json.loads(self._load_header()["header-info"])
+
+    @property
+    def artifact_name(self):
+        return self.artifact_provides["artifact_name"]
+
+    @property
+    def artifact_provides(self):
+        return self.header_info["artifact_provides"]
+
+    @property
+    def artifact_depends(self):
+        return self.header_info["artifact_depends"]
+
+    @property
+    def scripts(self):
+        """
+        The state scripts, {name: contents (bytes)}.
+        """
+        return {
+            name[len("scripts/") :]: data
+            for name, data in self._load_header().items()
+            if name.startswith("scripts/")
+        }
+
+    @property
+    def payloads(self):
+        """
+        Number of payloads.
+        """
+        return len(self.header_info["payloads"])
+
+    def type_info(self, index=0):
+        return json.loads(self._load_header()["headers/%04d/type-info" % index])
+
+    def meta_data(self, index=0):
+        """
+        The meta-data of a payload (dict), None if it has none.
+        """
+        data = self._load_header().get("headers/%04d/meta-data" % index)
+        return json.loads(data) if data else None
+
+    def payload_name(self, index=0):
+        return "data/%04d.tar%s" % (index, self.compression.suffix)
+
+    def payload_files(self, index=0):
+        """
+        Names of the files of a payload (in data/NNNN/), from the manifest.
+        """
+        prefix = "data/%04d/" % index
+        return [
+            filename[len(prefix) :]
+            for filename in self.manifest
+            if filename.startswith(prefix)
+        ]
+
+    def open_payload(self, index=0):
+        """
+        Streams the files of a payload, decompressing on the fly.
+        :returns: iterator of (tarfile.TarInfo, file object) pairs, the
+                  file object is valid until the next iteration
+        """
+        reader = self.compression.reader(self.open(self.payload_name(index)))
+        with tarfile.open(fileobj=reader, mode="r|") as tar:
+            for member in tar:
+                if member.isfile():
+                    yield member, tar.extractfile(member)
+
+    def verify(self, public_key=None, payloads=False):
+        """
+        Checks the manifest checksums of version and the header, and the
+        manifest signature if public_key (PEM) is given.
+        :param payloads: also check the payload checksums, which requires
+                         decompressing all payloads
+        :returns: True if the artifact is valid
+        """
+        manifest = self.manifest
+        for name in ("version", self.header_name):
+            sha = hashlib.sha256(self.read(name))
+            if manifest.get(name) != sha.hexdigest():
+                return False
+        if public_key is not None:
+            signature = self.signature
+            if signature is None or not artifact_verify(
+                self.read("manifest"), signature, public_key
+            ):
+                return False
+        if payloads:
+            for index in range(self.payloads):
+                for member, fd in self.open_payload(index):
+                    sha = hashlib.sha256()
+                    for buf in iter(lambda: fd.read(1024 * 1024), b""):
+                        sha.update(buf)
+                    filename = "data/%04d/%s" % (index, member.name)
+                    if manifest.get(filename) != sha.hexdigest():
+                        return False
+        return True
+
+
+def restamp(
+    src,
+    dest,
+    artifact_name=None,
+    artifact_group=None,
+    artifact_provides=None,
+    artifact_depends=None,
+    provides=None,
+    depends=None,
+    private_key=None,
+):
+    """
+    restamp copies the artifact src to dest with a new name, provides or
+    depends, rewriting only the header and the manifest: the compressed
+    payloads are copied byte for byte, so renaming a rootfs artifact costs
+    a file copy instead of recompressing the image.
+    The software version provides (rootfs-image[.<module>].version) that
+    were the old artifact name are renamed along.
+    :param src:               path or file object of the artifact
+    :param dest:              path or writable file object, see Artifact.write
+    :param artifact_name:     new name of the artifact (str)
+    :param artifact_group:    new group provided by the artifact (str)
+    :param artifact_provides: header-info provides to add or replace (dict)
+    :param artifact_depends:  header-info depends to add or replace (dict)
+    :param provides:          provides of the first payload to add or
+                              replace (dict)
+    :param depends:           depends of the first payload to add or
+                              replace (dict)
+    :param private_key:       PEM private key re-signing the manifest;
+                              without it the result is unsigned
+    """
+    if isinstance(dest, (str, os.PathLike)):
+        with open(dest, "wb") as f:
+            return restamp(
+                src,
+                f,
+                artifact_name,
+                artifact_group,
+                artifact_provides,
+                artifact_depends,
+                provides,
+                depends,
+                private_key,
+            )
+
+    with MenderArtifactReader(src) as reader:
+        old_name = reader.artifact_name
+        header_info = reader.header_info
+        header_info["artifact_provides"].update(artifact_provides or {})
+        header_info["artifact_depends"].update(artifact_depends or {})
+        if artifact_name is not None:
+            header_info["artifact_provides"]["artifact_name"] = artifact_name
+        if artifact_group is not None:
+            header_info["artifact_provides"]["artifact_group"] = artifact_group
+        new_name = header_info["artifact_provides"]["artifact_name"]
+
+        header = {}
+        for name, data in reader._load_header().items():
+            if name == "header-info":
+                data = json.dumps(header_info).encode()
+            elif name.startswith("headers/") and name.endswith("/type-info"):
+                typeinfo = json.loads(data)
+                typeinfo_provides = typeinfo.get("artifact_provides") or {}
+                for key, value in typeinfo_provides.items():
+                    if key.startswith("rootfs-image.") and key.endswith(".version"):
+                        if value == old_name:
+                            typeinfo_provides[key] = new_name
+                if name == "headers/0000/type-info":
+                    typeinfo_provides.update(provides or {})
+                    if depends:
+                        typeinfo.setdefault("artifact_depends", {}).update(depends)
+                if typeinfo_provides:
+                    typeinfo["artifact_provides"] = typeinfo_provides
+                data = json.dumps(typeinfo).encode()
+            header[name] = data
+
+        hdr_tarbin = io.BytesIO()
+        hdr_tar, compressor = _open_tar(
+            hdr_tarbin, reader.compression, reader.compression.default_level
+        )
+        for name, data in header.items():
+            tarhdr = tarfile.TarInfo(name)
+            tarhdr.size = len(data)
+            hdr_tar.addfile(tarhdr, io.BytesIO(data))
+        hdr_tar.close()
+        compressor.close()
+        hdr_sha = hashlib.sha256(hdr_tarbin.getvalue()).hexdigest()
+
+        manifest = b"".join(
+            (
+                "%s  %s\n"
+                % (hdr_sha if filename == reader.header_name else sha, filename)
+            ).encode()
+            for filename, sha in reader.manifest.items()
+        )
+
+        entries = []
+        for name in reader.names():
+            if name == "manifest":
+                entries.append((name, manifest))
+                if private_key is not None:
+                    signature = artifact_sign(manifest, private_key).encode()
+                    entries.append(("manifest.sig", signature))
+            elif name == reader.header_name:
+                entries.append((name, hdr_tarbin.getvalue()))
+            elif name != "manifest.sig":
+                entries.append((name, None))
+
+        tar = tarfile.open(fileobj=dest, mode="w|")
+        for name, data in entries:
+            tarhdr = tarfile.TarInfo(name)
+            if data is None:
+                # payloads: copied from the mapped artifact as they are
+                tarhdr.size = reader.size(name)
+                tar.addfile(tarhdr, reader.open(name))
+            else:
+                tarhdr.size = len(data)
+                tar.addfile(tarhdr, io.BytesIO(data))
+        tar.close()
+
+
+def rootfs_image(artifact_name, device_types, payload, **kwargs):
+    """
+    Builds an artifact like `mender-artifact write rootfs-image` does: the
+    payload is a filesystem image, which provides its checksum and
+    rootfs-image.version (the artifact name) and clears the provides of the
+    previous rootfs.
+    :param payload: the filesystem image (file, io.IOBase, str, bytes)
+    :param kwargs:  depends, provides and state scripts ({state: script}) of
+                    the payload, other arguments are passed to Artifact
+    """
+    provides = dict(kwargs.pop("provides", None) or {})
+    provides.setdefault("rootfs-image.version", artifact_name)
+    return _make_image(
+        artifact_name,
+        device_types,
+        payload,
+        "rootfs-image",
+        provides=provides,
+        clears_provides=["artifact_group", "rootfs_image_checksum", "rootfs-image.*"],
+        checksum_provide="rootfs-image.checksum",
+        **kwargs,
+    )
+
+
+def module_image(artifact_name, device_types, payload, update_module, **kwargs):
+    """
+    Builds an artifact like `mender-artifact write module-image` does: the
+    payload is handled by update_module on the device and provides
+    rootfs-image.<update_module>.version (the artifact name).
+    :param payload: the payload file (file, io.IOBase, str, bytes)
+    :param kwargs:  see rootfs_image
+    """
+    provides = dict(kwargs.pop("provides", None) or {})
+    provides.setdefault("rootfs-image.%s.version" % update_module, artifact_name)
+    return _make_image(
+        artifact_name,
+        device_types,
+        payload,
+        update_module,
+        provides=provides,
+        clears_provides=["rootfs-image.%s.*" % update_module],
+        **kwargs,
+    )
+
+
+def delta_rootfs_image(artifact_name, device_types, source, target, **kwargs):
+    """
+    Builds a binary delta artifact updating the filesystem image source to
+    target, like mender-binary-delta-generator does: the payload is an
+    xdelta3 (VCDIFF) patch, which depends on the checksum of source as
+    provided by rootfs_image artifacts, and provides that of target.
+    Requires xdelta3 in PATH.
+    :param source: path of the filesystem image installed on the device
+    :param target: path of the filesystem image to update to
+    :param kwargs: see rootfs_image, plus delta_level (xdelta3 level 0-9);
+                   the payload is not compressed by default since the patch
+                   already is
+    """
+    level = kwargs.pop("delta_level", 9)
+    kwargs.setdefault("compression", "none")
+    depends = dict(kwargs.pop("depends", None) or {})
+    depends["rootfs-image.checksum"] = file_sha256(source)
+    provides = dict(kwargs.pop("provides", None) or {})
+    provides["rootfs-image.checksum"] = file_sha256(target)
+    provides.setdefault("rootfs-image.version", artifact_name)
+
+    fd, path = tempfile.mkstemp(suffix=".vcdiff")
+    os.close(fd)
+    try:
+        make_delta(source, target, path, level)
+        # the open file outlives its name, until the artifact closes it
+        patch = open(path, "rb")
+    finally:
+        os.unlink(path)
+    return _make_image(
+        artifact_name,
+        device_types,
+        patch,
+        DELTA_PAYLOAD_TYPE,
+        depends=depends,
+        provides=provides,
+        clears_provides=["artifact_group", "rootfs_image_checksum", "rootfs-image.*"],
+        name=kwargs.pop("name", None) or os.path.basename(target) + ".vcdiff",
+        **kwargs,
+    )
+
+
+def make_delta(source, target, dest, level=9):
+    """
+    Writes the xdelta3 (VCDIFF) patch turning the file source into target
+    to the path dest.
+    """
+    xdelta3 = shutil.which("xdelta3")
+    if xdelta3 is None:
+        raise RuntimeError("xdelta3 not found in PATH")
+    # Let the source window cover the whole image (up to xdelta3's 2 GiB
+    # limit): blocks of a rebuilt filesystem move far.
+    window = min(max(os.path.getsize(source), 1 << 20), 1 << 31)
+    subprocess.check_call(
+        [xdelta3, "-e", "-f", "-%d" % level, "-B", str(window)]
+        + ["-s", source, target, dest]
+    )
+
+
+def file_sha256(path):
+    """
+    Returns the sha256 of a file, reading it sparse-aware.
+    """
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        reader = _SparseReader(f) if _SparseReader.supported(f) else f
+        for buf in iter(lambda: reader.read(1024 * 1024), b""):
+            sha.update(buf)
+    return sha.hexdigest()
+
+
+def _make_image(
+    artifact_name,
+    device_types,
+    payload,
+    payload_type,
+    depends=None,
+    provides=None,
+    clears_provides=None,
+    checksum_provide=None,
+    scripts=None,
+    name=None,
+    **kwargs,
+):
+    artifact = Artifact(artifact_name, list(device_types), **kwargs)
+    artifact.add_payload(
+        payload,
+        payload_type,
+        depends=depends,
+        provides=provides,
+        clears_provides=clears_provides,
+        checksum_provide=checksum_provide,
+        name=name,
+    )
+    for state, script in (scripts or {}).items():
+        artifact.add_state_script(state, script)
+    return artifact
+
+
+def parse_key_values(items):
+    """
+    Parses mender-artifact style "key:value" depends/provides into a dict.
+    """
+    result = {}
+    for item in items:
+        key, sep, value = item.partition(":")
+        if not sep:
+            raise ValueError('%s is not of the form "key:value"' % item)
+        result[key] = value
+    return result
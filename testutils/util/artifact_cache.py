@@ -0,0 +1,248 @@
+# Copyright 2020 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Content-addressed on-disk cache of compressed artifact payload sections
+# (data/NNNN.tar.*), so that rebuilding an artifact of the same payload,
+# e.g. the same rootfs image under a new artifact name, only rebuilds the
+# header. Shared by all processes (xdist workers) using the same directory:
+# entries are published with atomic renames and never modified, builds of
+# the same entry are serialized with a lock file per key, and eviction
+# (least recently used first, down to max_size bytes) runs under a
+# directory-wide lock.
+
+import errno
+import fcntl
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+
+# Directory of the cache, and its size cap in bytes (0 disables the cache).
+ARTIFACT_CACHE_DIR = os.environ.get("ARTIFACT_CACHE_DIR") or os.path.join(
+    tempfile.gettempdir(), "mender-artifact-cache-%d" % os.getuid()
+)
+ARTIFACT_CACHE_SIZE = int(
+    os.environ.get("ARTIFACT_CACHE_SIZE") or 4 * 1024 * 1024 * 1024
+)
+
+# Bumped whenever the layout of the cached payload sections changes.
+_FORMAT = 1
+
+
+class ArtifactCache:
+    def __init__(self, directory=ARTIFACT_CACHE_DIR, max_size=ARTIFACT_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._digests = {}
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, "entries"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "locks"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "digests"), exist_ok=True)
+
+    def key(self, payload_sha, name, compression, level):
+        """
+        Returns the key of the compressed section of a payload: its
+        checksum, the file name it has in the section and the compression.
+        """
+        return hashlib.sha256(
+            json.dumps([_FORMAT, payload_sha, name, compression, level]).encode()
+        ).hexdigest()
+
+    def known_digest(self, fd):
+        """
+        Returns the sha256 of a payload (file object) if it was remembered
+        before, by this or another process, else None. Digests of regular
+        files are remembered by device, inode, size and mtime.
+        """
+        stat_key = self._stat_key(fd)
+        if stat_key is None:
+            return None
+        with self._lock:
+            sha = self._digests.get(stat_key)
+        if sha is not None:
+            return sha
+        try:
+            with open(self._digest_file(stat_key)) as f:
+                sha = f.read()
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            self._digests[stat_key] = sha
+        return sha
+
+    def remember(self, fd, sha):
+        """
+        Remembers the sha256 of a payload, computed while compressing it,
+        see known_digest.
+        """
+        stat_key = self._stat_key(fd)
+        if stat_key is None:
+            return
+        with self._lock:
+            self._digests[stat_key] = sha
+        path = self._digest_file(stat_key)
+        tmp = "%s.tmp-%s" % (path, uuid.uuid4().hex)
+        with open(tmp, "w") as f:
+            f.write(sha)
+        os.rename(tmp, path)
+
+    def _stat_key(self, fd):
+        try:
+            st = os.fstat(fd.fileno())
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            # not a regular file, e.g. io.BytesIO
+            return None
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _digest_file(self, stat_key):
+        name = hashlib.sha256(json.dumps(stat_key).encode()).hexdigest()
+        return os.path.join(self.directory, "digests", name)
+
+    def get(self, key):
+        """
+        Returns (open file, payload sha256) of a cached section, or None.
+        """
+        entry = self._entry(key)
+        try:
+            f = open(os.path.join(entry, "section"), "rb")
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            with open(os.path.join(entry, "sha256")) as sha_file:
+                sha = sha_file.read()
+        except FileNotFoundError:
+            # evicted meanwhile
+            f.close()
+            with self._lock:
+                self.misses += 1
+            return None
+        # mtime of the entry is its last use, for the LRU eviction
+        try:
+            os.utime(entry)
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return f, sha
+
+    def put(self, key, section, payload_sha):
+        """
+        Stores a compressed section (file object, read from offset 0) and
+        the checksum of its payload, then evicts entries above max_size.
+        Does nothing if the entry exists already.
+        """
+        if os.path.isdir(self._entry(key)):
+            return
+        tmp = os.path.join(self.directory, "entries", ".tmp-%s" % uuid.uuid4().hex)
+        os.mkdir(tmp)
+        try:
+            section.seek(0)
+            with open(os.path.join(tmp, "section"), "wb") as f:
+                shutil.copyfileobj(section, f, 1024 * 1024)
+            with open(os.path.join(tmp, "sha256"), "w") as f:
+                f.write(payload_sha)
+            try:
+                os.rename(tmp, self._entry(key))
+            except OSError as e:
+                # another process stored it first
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    @contextmanager
+    def building(self, key):
+        """
+        Lock held while building the section of key, so that concurrent
+        builders of the same payload wait for the first one's result.
+        """
+        with open(os.path.join(self.directory, "locks", key), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits
+        max_size.
+        """
+        with open(os.path.join(self.directory, "evict.lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            total = 0
+            for entry in os.scandir(os.path.join(self.directory, "entries")):
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    size = os.stat(os.path.join(entry.path, "section")).st_size
+                    entries.append((entry.stat().st_mtime, size, entry))
+                except FileNotFoundError:
+                    continue
+                total += size
+            entries.sort(key=lambda e: e[0])
+            for _, size, entry in entries:
+                if total <= self.max_size:
+                    break
+                # rename first: readers either open the complete entry (and
+                # keep reading after it is removed) or find nothing
+                doomed = os.path.join(
+                    self.directory, "entries", ".evicted-%s" % uuid.uuid4().hex
+                )
+                os.rename(entry.path, doomed)
+                shutil.rmtree(doomed, ignore_errors=True)
+                try:
+                    os.unlink(os.path.join(self.directory, "locks", entry.name))
+                except FileNotFoundError:
+                    pass
+                total -= size
+                logger.debug("artifact cache: evicted %s" % entry.name)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+    def _entry(self, key):
+        return os.path.join(self.directory, "entries", key)
+
+
+_artifact_cache = None
+_artifact_cache_lock = threading.Lock()
+
+
+def get_artifact_cache():
+    """
+    Returns the process wide ArtifactCache, None if ARTIFACT_CACHE_SIZE is 0.
+    """
+    global _artifact_cache
+    if ARTIFACT_CACHE_SIZE <= 0:
+        return None
+    with _artifact_cache_lock:
+        if _artifact_cache is None:
+            _artifact_cache = ArtifactCache()
+        return _artifact_cache
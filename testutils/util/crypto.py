@@ -11,7 +11,18 @@
 #    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
-from base64 import b64encode
+import atexit
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+import uuid
+from base64 import b64decode, b64encode
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives import serialization
@@ -19,6 +30,11 @@ from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives.asymmetric import ed25519
 from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.exceptions import InvalidSignature, UnsupportedAlgorithm
+from cryptography.hazmat.primitives.asymmetric.utils import (
+    decode_dss_signature,
+    encode_dss_signature,
+)
 
 # enum for EC curve types to avoid naming confusion, e.g.
 # NIST P-256 (FIPS 186 standard name) ==
@@ -29,36 +45,227 @@ EC_CURVE_256 = ec.SECP256R1
 EC_CURVE_384 = ec.SECP384R1
 EC_CURVE_521 = ec.SECP521R1
 
+_EC_CURVES = {
+    c.name: c for c in (EC_CURVE_224, EC_CURVE_256, EC_CURVE_384, EC_CURVE_521)
+}
+
+# Number of pre-generated keypairs to keep ready per key type (0 disables the
+# pool), and optional directory where unused keypairs are kept across sessions.
+KEYPAIR_POOL_SIZE = int(os.environ.get("KEYPAIR_POOL_SIZE") or 16)
+KEYPAIR_CACHE_DIR = os.environ.get("KEYPAIR_CACHE_DIR")
+
 
 def compare_keys(a, b):
     """
-    Compares the base64 encoded DER structure of the keys
+    Compares the fingerprints (DER structure) of the keys, keys which
+    don't parse compare unequal
     """
-    # Filter removes possible empty lines.
-    # We then slice away header and footer.
-    a_b64 = "".join(list(filter(None, a.splitlines()))[1:-1])
-    b_b64 = "".join(list(filter(None, b.splitlines()))[1:-1])
-    return a_b64 == b_b64
+    try:
+        return pubkey_fingerprint(a) == pubkey_fingerprint(b)
+    except (ValueError, UnsupportedAlgorithm):
+        return False
 
 
-def get_keypair_rsa(public_exponent=65537, key_size=1024):
-    private_key = rsa.generate_private_key(
-        public_exponent=public_exponent, key_size=key_size, backend=default_backend(),
+@lru_cache(maxsize=16384)
+def pubkey_fingerprint(pubkey):
+    """
+    Returns the canonical fingerprint of a PEM public key: the hex SHA-256
+    of its DER SubjectPublicKeyInfo. Computed once per key.
+    """
+    key = serialization.load_pem_public_key(
+        pubkey if isinstance(pubkey, bytes) else pubkey.encode(),
+        backend=default_backend(),
+    )
+    der = key.public_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo,
     )
+    return hashlib.sha256(der).hexdigest()
 
-    return keypair_pem(private_key, private_key.public_key())
+
+def get_keypair_rsa(public_exponent=65537, key_size=1024):
+    return get_keypair_pool().get(("rsa", public_exponent, key_size))
 
 
 def get_keypair_ec(curve):
-    private_key = ec.generate_private_key(curve=curve, backend=default_backend(),)
-    return keypair_pem(private_key, private_key.public_key())
+    return get_keypair_pool().get(("ec", curve.name))
 
 
 def get_keypair_ed():
-    private_key = ed25519.Ed25519PrivateKey.generate()
+    return get_keypair_pool().get(("ed25519",))
+
+
+def generate_keypair(spec):
+    """Generates a new PEM keypair for spec, one of:
+    ("rsa", public_exponent, key_size), ("ec", curve_name), ("ed25519",)
+    """
+    if spec[0] == "rsa":
+        private_key = rsa.generate_private_key(
+            public_exponent=spec[1], key_size=spec[2], backend=default_backend(),
+        )
+    elif spec[0] == "ec":
+        private_key = ec.generate_private_key(
+            curve=_EC_CURVES[spec[1]], backend=default_backend(),
+        )
+    elif spec[0] == "ed25519":
+        private_key = ed25519.Ed25519PrivateKey.generate()
+    else:
+        raise ValueError("unsupported key spec %s" % str(spec))
     return keypair_pem(private_key, private_key.public_key())
 
 
+class KeypairPool:
+    """Pool of pre-generated keypairs, keyed by key spec (see generate_keypair).
+
+    Keys are generated ahead of time by a process pool and handed out only
+    once, so callers still get unique keys. A request the pool can't serve
+    is a miss and generates the key inline. Each request tops the pool up
+    in the background, to its size plus the number of requests currently
+    waiting for a key, so that concurrent callers don't drain it.
+    If cache_dir is set, unused keys are stored there at exit and claimed
+    from there first by later sessions; a claim is an atomic rename, so the
+    directory can be shared between concurrent processes (xdist workers).
+    """
+
+    def __init__(self, size=KEYPAIR_POOL_SIZE, cache_dir=KEYPAIR_CACHE_DIR):
+        self.size = size
+        self.cache_dir = cache_dir
+        self._keys = {}
+        self._inflight = {}
+        self._waiting = {}
+        self._futures = set()
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def get(self, spec):
+        spec = tuple(spec)
+        with self._lock:
+            stats = self._stats.setdefault(spec, {"hits": 0, "misses": 0})
+            keys = self._keys.get(spec)
+            keypair = keys.popleft() if keys else None
+            self._waiting[spec] = self._waiting.get(spec, 0) + 1
+        try:
+            if keypair is None:
+                keypair = self._claim_cached(spec)
+                cached = keypair is not None
+            else:
+                cached = False
+            with self._lock:
+                stats["hits" if keypair is not None else "misses"] += 1
+            # while the on-disk cache lasts, it is the pool
+            if self.size > 0 and not cached:
+                self._refill(spec)
+            return keypair if keypair is not None else generate_keypair(spec)
+        finally:
+            with self._lock:
+                self._waiting[spec] -= 1
+
+    def stats(self):
+        """Returns the hit/miss counters per key spec."""
+        with self._lock:
+            return {spec: dict(stats) for spec, stats in self._stats.items()}
+
+    def _refill(self, spec):
+        futures = []
+        with self._lock:
+            ready = len(self._keys.get(spec, ())) + self._inflight.get(spec, 0)
+            missing = self.size + self._waiting.get(spec, 0) - ready
+            if missing <= 0:
+                return
+            if self._executor is None:
+                # forkserver: don't fork a process full of (HTTP pool) threads
+                self._executor = ProcessPoolExecutor(
+                    mp_context=multiprocessing.get_context("forkserver")
+                )
+                atexit.register(self.close)
+            for _ in range(missing):
+                try:
+                    fut = self._executor.submit(generate_keypair, spec)
+                except Exception:
+                    # broken process pool: keep generating keys inline
+                    self.size = 0
+                    break
+                self._inflight[spec] = self._inflight.get(spec, 0) + 1
+                self._futures.add(fut)
+                futures.append(fut)
+        # not under the lock: the callback runs right away if fut is done
+        for fut in futures:
+            fut.add_done_callback(lambda f, spec=spec: self._generated(spec, f))
+
+    def _generated(self, spec, fut):
+        with self._lock:
+            self._futures.discard(fut)
+            self._inflight[spec] -= 1
+            if not fut.cancelled() and fut.exception() is None:
+                self._keys.setdefault(spec, deque()).append(fut.result())
+
+    def _spec_dir(self, spec):
+        return os.path.join(self.cache_dir, "-".join(str(s) for s in spec))
+
+    def _claim_cached(self, spec):
+        if self.cache_dir is None:
+            return None
+        spec_dir = self._spec_dir(spec)
+        try:
+            names = os.listdir(spec_dir)
+        except FileNotFoundError:
+            return None
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(spec_dir, name)
+            claimed = "%s.%d.%d" % (path, os.getpid(), threading.get_ident())
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                # claimed by somebody else
+                continue
+            with open(claimed) as f:
+                keypair = json.load(f)
+            os.unlink(claimed)
+            return keypair["private"], keypair["public"]
+        return None
+
+    def _store_cached(self, spec, keypairs):
+        spec_dir = self._spec_dir(spec)
+        os.makedirs(spec_dir, exist_ok=True)
+        for private, public in keypairs:
+            path = os.path.join(spec_dir, uuid.uuid4().hex)
+            with open(path + ".tmp", "w") as f:
+                json.dump({"private": private, "public": public}, f)
+            os.rename(path + ".tmp", path + ".json")
+
+    def close(self):
+        """Stops background generation, persisting unused keys if cache_dir
+        is set."""
+        with self._lock:
+            futures = list(self._futures)
+        for fut in futures:
+            fut.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        with self._lock:
+            keys = self._keys
+            self._keys = {}
+        if self.cache_dir is not None:
+            for spec, keypairs in keys.items():
+                self._store_cached(spec, keypairs)
+
+
+_keypair_pool = None
+_keypair_pool_lock = threading.Lock()
+
+
+def get_keypair_pool():
+    global _keypair_pool
+    with _keypair_pool_lock:
+        if _keypair_pool is None:
+            _keypair_pool = KeypairPool()
+        return _keypair_pool
+
+
 def keypair_pem(private_key, public_key):
     private_pem = private_key.private_bytes(
         encoding=serialization.Encoding.PEM,
@@ -94,18 +301,141 @@ def auth_req_sign_ed(data, private_key):
     return b64encode(signature).decode()
 
 
+class Signer:
+    """Signs auth requests, keeping the parsed private keys of the last
+    cache_size PEMs (keyed by PEM digest) so re-signing with the same key
+    doesn't re-parse it.
+    """
+
+    def __init__(self, cache_size=1024):
+        self.cache_size = cache_size
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def load(self, private_key):
+        """Returns the parsed key object of a PEM private key (str, bytes)."""
+        pem = private_key if isinstance(private_key, bytes) else private_key.encode()
+        digest = hashlib.sha256(pem).digest()
+        with self._lock:
+            key = self._keys.get(digest)
+            if key is not None:
+                self._keys.move_to_end(digest)
+                return key
+        key = serialization.load_pem_private_key(
+            pem, password=None, backend=default_backend(),
+        )
+        with self._lock:
+            self._keys[digest] = key
+            if len(self._keys) > self.cache_size:
+                self._keys.popitem(last=False)
+        return key
+
+    def sign(self, data, private_key):
+        key = self.load(private_key)
+        if isinstance(key, rsa.RSAPrivateKey):
+            return auth_req_sign_rsa(data, key)
+        elif isinstance(key, ec.EllipticCurvePrivateKey):
+            return auth_req_sign_ec(data, key)
+        elif isinstance(key, ed25519.Ed25519PrivateKey):
+            return auth_req_sign_ed(data, key)
+        else:
+            raise RuntimeError("unsupported key type")
+
+    def sign_many(self, reqs, min_batch=64):
+        """Signs a list of (data, private_key) pairs, returns the signatures
+        in the same order.
+        Batches of at least min_batch requests are spread across all cores.
+        """
+        reqs = list(reqs)
+        if len(reqs) < min_batch:
+            return [self.sign(data, key) for data, key in reqs]
+        with self._lock:
+            if self._executor is None:
+                # forkserver: don't fork a process full of (HTTP pool) threads
+                self._executor = ProcessPoolExecutor(
+                    mp_context=multiprocessing.get_context("forkserver")
+                )
+                atexit.register(self.close)
+            executor = self._executor
+        chunksize = max(1, len(reqs) // (4 * (os.cpu_count() or 1)))
+        return list(executor.map(_sign, reqs, chunksize=chunksize))
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+
+_signer = Signer()
+
+
+def get_signer():
+    return _signer
+
+
+def _sign(req):
+    # runs in the Signer's worker processes, each with its own key cache
+    return _signer.sign(*req)
+
+
 def auth_req_sign(data, private_key):
-    key = serialization.load_pem_private_key(
-        private_key if isinstance(private_key, bytes) else private_key.encode(),
-        password=None,
-        backend=default_backend(),
+    return _signer.sign(data, private_key)
+
+
+def auth_req_sign_many(reqs):
+    """Signs a list of (data, private_key) pairs, see Signer.sign_many."""
+    return _signer.sign_many(reqs)
+
+
+def artifact_sign(data, private_key):
+    """
+    Signs data (an artifact manifest) with a PEM private key the way
+    mender-artifact does: RSA and ed25519 signatures are the same as for
+    auth requests, ECDSA signatures are the raw r || s pair, each padded to
+    the curve size, instead of a DER sequence.
+    """
+    key = _signer.load(private_key)
+    if not isinstance(key, ec.EllipticCurvePrivateKey):
+        return _signer.sign(data, private_key)
+    r, s = decode_dss_signature(
+        key.sign(
+            data if isinstance(data, bytes) else data.encode(),
+            ec.ECDSA(hashes.SHA256()),
+        )
     )
+    size = (key.curve.key_size + 7) // 8
+    return b64encode(r.to_bytes(size, "big") + s.to_bytes(size, "big")).decode()
 
-    if isinstance(key, rsa.RSAPrivateKey):
-        return auth_req_sign_rsa(data, key)
-    elif isinstance(key, ec.EllipticCurvePrivateKey):
-        return auth_req_sign_ec(data, key)
-    elif isinstance(key, ed25519.Ed25519PrivateKey):
-        return auth_req_sign_ed(data, key)
-    else:
-        raise RuntimeError("unsupported key type")
+
+def artifact_verify(data, signature, public_key):
+    """
+    Verifies a signature made by artifact_sign (or mender-artifact) with a
+    PEM public key, returns whether it is valid.
+    """
+    key = serialization.load_pem_public_key(
+        public_key if isinstance(public_key, bytes) else public_key.encode(),
+        backend=default_backend(),
+    )
+    data = data if isinstance(data, bytes) else data.encode()
+    signature = b64decode(signature)
+    try:
+        if isinstance(key, rsa.RSAPublicKey):
+            key.verify(signature, data, padding.PKCS1v15(), hashes.SHA256())
+        elif isinstance(key, ec.EllipticCurvePublicKey):
+            size = (key.curve.key_size + 7) // 8
+            if len(signature) != 2 * size:
+                return False
+            r = int.from_bytes(signature[:size], "big")
+            s = int.from_bytes(signature[size:], "big")
+            key.verify(
+                encode_dss_signature(r, s), data, ec.ECDSA(hashes.SHA256()),
+            )
+        elif isinstance(key, ed25519.Ed25519PublicKey):
+            key.verify(signature, data)
+        else:
+            raise RuntimeError("unsupported key type")
+    except InvalidSignature:
+        return False
+    return True
@@ -0,0 +1,93 @@
+# Copyright 2020 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        https://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Polling with adaptive backoff. Most resources the tests wait for (a new
+# user, a traefik router) are ready within milliseconds, so start polling
+# fast and back off exponentially up to max_delay, until the deadline.
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger()
+
+_wait_times = {}
+_wait_times_lock = threading.Lock()
+
+
+class WaitTimeout(TimeoutError):
+    """Raised when the deadline passes; `last` holds the last polled value."""
+
+    def __init__(self, msg, last=None):
+        TimeoutError.__init__(self, msg)
+        self.last = last
+
+
+def wait_until(
+    fn,
+    timeout,
+    ready=bool,
+    ignore=(),
+    name=None,
+    initial_delay=0.005,
+    max_delay=1.0,
+    factor=2.0,
+):
+    """Calls fn() until ready(result) holds, returns that result.
+
+    :param timeout:       deadline in seconds
+    :param ready:         predicate on fn's result, truthiness by default
+    :param ignore:        exception types raised by fn meaning "not ready"
+    :param name:          name to record the wait time under, see wait_stats
+    :param initial_delay: first sleep between attempts, in seconds
+    :param max_delay:     upper bound of the sleep between attempts
+    :param factor:        backoff multiplier
+    """
+    name = name or getattr(fn, "__name__", "wait")
+    start = time.monotonic()
+    deadline = start + timeout
+    delay = initial_delay
+    last = None
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            last = fn()
+            if ready(last):
+                _record(name, time.monotonic() - start, attempts)
+                return last
+        except ignore as e:
+            logger.debug("%s: not ready yet: %s" % (name, e))
+
+        now = time.monotonic()
+        if now >= deadline:
+            _record(name, now - start, attempts)
+            raise WaitTimeout(
+                "%s: not ready after %.1fs (%d attempts)" % (name, timeout, attempts),
+                last,
+            )
+        time.sleep(min(delay, deadline - now))
+        delay = min(delay * factor, max_delay)
+
+
+def _record(name, elapsed, attempts):
+    logger.info("%s: waited %.3fs (%d attempts)" % (name, elapsed, attempts))
+    with _wait_times_lock:
+        _wait_times.setdefault(name, []).append(elapsed)
+
+
+def wait_stats():
+    """Returns the recorded wait times, {name: [seconds, ...]}."""
+    with _wait_times_lock:
+        return {name: list(times) for name, times in _wait_times.items()}